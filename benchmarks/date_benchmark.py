@@ -0,0 +1,89 @@
+"""
+Benchmark of parsing.parse_date against the previous locale + strptime implementation.
+Dates are taken from the synthetic results pages in benchmarks/fixtures.
+
+Run from the repository root:
+    python benchmarks/date_benchmark.py
+    python benchmarks/date_benchmark.py --repeat 500
+
+The legacy implementation needs fi_FI.UTF-8 locale, it is skipped if the locale is not installed.
+"""
+import argparse
+import glob
+import locale
+import os
+import pytz
+import sys
+import time
+
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import parsing  # noqa: E402
+from constants import FIN_MON_ABBREVS, TODAY, YESTERDAY  # noqa: E402
+from extraction import extract_rows  # noqa: E402
+
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def legacy_parse_date(listing_date_str):
+    """
+    Date parsing as it was done in list_announcements before parse_date
+    """
+    locale.setlocale(locale.LC_TIME, 'fi_FI.UTF-8')
+    str_split = listing_date_str.split(' ')
+    if len(str_split) == 2:
+        listing_date_str = listing_date_str.replace(TODAY, datetime.today().strftime('%d %Bta'))\
+            .replace(YESTERDAY, (datetime.today() - timedelta(days=1)).strftime('%d %Bta'))
+    else:
+        listing_date_str = listing_date_str.replace(str_split[1], FIN_MON_ABBREVS.get(str_split[1], str_split[1]))
+    tz = pytz.timezone('Europe/Helsinki')
+
+    listing_date = datetime.strptime(listing_date_str, '%d %Bta %H:%M')
+    listing_date = listing_date.replace(year=datetime.today().year)
+    date_aware = tz.normalize(tz.localize(listing_date)).astimezone(pytz.utc)
+    if date_aware > datetime.now(timezone.utc):
+        date_aware = date_aware.replace(year=date_aware.year - 1)
+    return date_aware
+
+
+def load_dates():
+    dates = []
+    for path in sorted(glob.glob(os.path.join(FIXTURES_DIR, 'results_*.html'))):
+        with open(path, 'rb') as f:
+            dates.extend(row['date'] for row in extract_rows(f.read()))
+    return dates
+
+
+def run(parse, dates, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for date in dates:
+            parse(date)
+    return time.perf_counter() - started
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Benchmark tori.fi date parsing')
+    arg_parser.add_argument('--repeat', type=int, default=200, help='parses of every fixture date')
+    args = arg_parser.parse_args()
+
+    dates = load_dates()
+    implementations = {'parse_date': parsing.parse_date}
+    try:
+        legacy_parse_date(dates[0])
+        implementations['legacy'] = legacy_parse_date
+    except locale.Error:
+        print('fi_FI.UTF-8 locale is not installed, legacy implementation is skipped.')
+
+    print('{:<12} {:>8} {:>10} {:>14}'.format('parser', 'dates', 'us/date', 'dates/sec'))
+    for name, parse in implementations.items():
+        seconds = run(parse, dates, args.repeat)
+        count = len(dates) * args.repeat
+        print('{:<12} {:>8} {:>10.2f} {:>14.0f}'.format(name, count, seconds * 1e6 / count, count / seconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""
+Parser micro-benchmark on the pages from benchmarks/fixtures.
+The fixtures are synthetic pages that follow the markup of tori.fi, they are not recorded from the site, so the
+timings, memory and --check agreement only hold for the markup the extractors were written against.
+
+Run from the repository root:
+    python benchmarks/parse_benchmark.py
+    python benchmarks/parse_benchmark.py --parsers lxml --repeat 200
+    python benchmarks/parse_benchmark.py --check
+
+Fixtures named results_*.html are results pages, detail_*.html are listing pages.
+Every parser from PARSERS is a value of HTML_PARSER, to benchmark a new parser add it there.
+"""
+import argparse
+import glob
+import logging
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import parsing  # noqa: E402
+
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+PARSERS = ['html5lib', 'lxml']
+DETAIL_URL = 'https://www.tori.fi/pirkanmaa/fixture_100000.htm'
+
+
+def load_fixtures(prefix):
+    fixtures = {}
+    for path in sorted(glob.glob(os.path.join(FIXTURES_DIR, prefix + '_*.html'))):
+        with open(path, 'rb') as f:
+            fixtures[os.path.basename(path)] = f.read()
+    return fixtures
+
+
+def parse(name, content):
+    if name.startswith('results'):
+        return parsing.parse_listings_page(content)
+    return parsing.parse_listing_info(content, DETAIL_URL)
+
+
+def benchmark(parser, fixtures, repeat):
+    """
+    :return: dict with number of pages, listings, total time and peak memory of a single parse
+    """
+    parsing.HTML_PARSER = parser
+    stats = {'pages': 0, 'listings': 0, 'seconds': 0., 'peak_kb': 0.}
+    for name, content in fixtures.items():
+        tracemalloc.start()
+        parsed = parse(name, content)
+        stats['peak_kb'] = max(stats['peak_kb'], tracemalloc.get_traced_memory()[1] / 1024)
+        tracemalloc.stop()
+
+        started = time.perf_counter()
+        for _ in range(repeat):
+            parse(name, content)
+        stats['seconds'] += time.perf_counter() - started
+        stats['pages'] += repeat
+        stats['listings'] += repeat * (len(parsed) if isinstance(parsed, list) else isinstance(parsed, dict))
+    return stats
+
+
+def check(parsers, fixtures):
+    """
+    Compares output of every parser with the first one. All of the fields are compared, uid is derived from the
+    listing link, so it is the same on every parse
+    :return: True if all of the outputs are equal
+    """
+    ok = True
+    for name, content in fixtures.items():
+        parsing.HTML_PARSER = parsers[0]
+        reference = parse(name, content)
+        for parser in parsers[1:]:
+            parsing.HTML_PARSER = parser
+            if parse(name, content) != reference:
+                print('{}: {} output differs from {}'.format(name, parser, parsers[0]))
+                ok = False
+    return ok
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Benchmark tori.fi page parsing on synthetic fixtures')
+    arg_parser.add_argument('--parsers', nargs='+', default=PARSERS, choices=PARSERS)
+    arg_parser.add_argument('--repeat', type=int, default=50, help='parses of every fixture per parser')
+    arg_parser.add_argument('--check', action='store_true', help='only check that all parsers give the same output')
+    args = arg_parser.parse_args()
+
+    parsing.PARSER_COMPAT_CHECK = False
+    parsing.logger.setLevel(logging.ERROR)  # unknown bid types in fixtures are expected
+    fixtures = {kind: load_fixtures(kind) for kind in ('results', 'detail')}
+    if args.check:
+        ok = check(args.parsers, {**fixtures['results'], **fixtures['detail']})
+        print('All parsers agree.' if ok else 'Parsers disagree.')
+        sys.exit(0 if ok else 1)
+
+    print('{:<10} {:<8} {:>7} {:>10} {:>14} {:>12}'.format('parser', 'pages', 'count', 'ms/page', 'listings/sec',
+                                                           'peak mem, KB'))
+    for parser in args.parsers:
+        for kind, kind_fixtures in fixtures.items():
+            stats = benchmark(parser, kind_fixtures, args.repeat)
+            print('{:<10} {:<8} {:>7} {:>10.3f} {:>14.1f} {:>12.1f}'.format(
+                parser, kind, stats['pages'], stats['seconds'] * 1000 / stats['pages'],
+                stats['listings'] / stats['seconds'], stats['peak_kb']))
+
+
+if __name__ == '__main__':
+    main()
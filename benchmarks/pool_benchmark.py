@@ -0,0 +1,78 @@
+"""
+Benchmark of the parse pool: throughput of concurrent results page parsing and the longest event loop stall
+while the pages are parsed, for several numbers of PARSE_WORKERS (0 means inline parsing).
+
+Run from the repository root on the host you want to measure:
+    python benchmarks/pool_benchmark.py
+    python benchmarks/pool_benchmark.py --workers 0 2 4 8 --pages 400
+"""
+import argparse
+import asyncio
+import glob
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import parsing  # noqa: E402
+
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+TICK = 0.005  # seconds between event loop responsiveness probes
+
+
+def load_pages():
+    pages = []
+    for path in sorted(glob.glob(os.path.join(FIXTURES_DIR, 'results_*.html'))):
+        with open(path, 'rb') as f:
+            pages.append(f.read())
+    return pages
+
+
+async def probe_loop(stop, lags):
+    """
+    Measures how late the event loop wakes up the sleeping coroutine
+    """
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(TICK)
+        lags.append(time.perf_counter() - started - TICK)
+
+
+async def run(pages, count):
+    stop = asyncio.Event()
+    lags = []
+    probe = asyncio.create_task(probe_loop(stop, lags))
+    await asyncio.sleep(0)
+    # warm up the workers, so process start is not measured
+    await asyncio.gather(*[parsing.parse_listings_page_async(pages[0]) for _ in range(parsing.PARSE_WORKERS or 1)])
+    started = time.perf_counter()
+    await asyncio.gather(*[parsing.parse_listings_page_async(pages[i % len(pages)]) for i in range(count)])
+    seconds = time.perf_counter() - started
+    stop.set()
+    await probe
+    return seconds, max(lags) if lags else 0.
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Benchmark parsing in the process pool')
+    arg_parser.add_argument('--workers', nargs='+', type=int, default=[0, 1, 2, os.cpu_count() or 1])
+    arg_parser.add_argument('--pages', type=int, default=200, help='results pages parsed concurrently')
+    args = arg_parser.parse_args()
+
+    parsing.logger.setLevel(logging.ERROR)  # unknown bid types in fixtures are expected
+    pages = load_pages()
+    print('CPU count: {}'.format(os.cpu_count()))
+    print('{:<8} {:>8} {:>12} {:>16}'.format('workers', 'pages', 'pages/sec', 'max loop lag, ms'))
+    for workers in args.workers:
+        parsing.close_parse_pool()
+        parsing.PARSE_WORKERS = workers
+        seconds, lag = asyncio.run(run(pages, args.pages))
+        print('{:<8} {:>8} {:>12.1f} {:>16.1f}'.format(workers, args.pages, args.pages / seconds, lag * 1000))
+    parsing.close_parse_pool()
+
+
+if __name__ == '__main__':
+    main()
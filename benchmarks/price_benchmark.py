@@ -0,0 +1,96 @@
+"""
+Benchmark of the price filter pushdown: results pages fetched by price filtered searches with and without ps=/pe=
+in the query. tori.fi is simulated by a catalogue of the listings from the results_*.html fixtures with random prices,
+it serves only the listings within the requested price options, MAX_ITEMS_ON_PAGE per page.
+
+Run from the repository root:
+    python benchmarks/price_benchmark.py
+    python benchmarks/price_benchmark.py --listings 5000 --max-items 10
+"""
+import argparse
+import asyncio
+import glob
+import logging
+import os
+import random
+import re
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import parsing  # noqa: E402
+from constants import MAX_ITEMS_ON_PAGE, PRICE_BUCKETS  # noqa: E402
+
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+PRICE_RANGES = [(None, 20), (10, 40), (60, 90), (200, 400), (700, 900), (3000, None)]
+QUERY_RE = re.compile(r'&(ps|pe|o)=(\d+)')
+
+
+def load_catalogue(size, seed):
+    """
+    :return: list[dict] of size listings with unique ids and random prices
+    """
+    rows = []
+    for path in sorted(glob.glob(os.path.join(FIXTURES_DIR, 'results_*.html'))):
+        with open(path, 'rb') as f:
+            rows.extend(parsing.parse_listings_page(f.read()))
+    rng = random.Random(seed)
+    catalogue = []
+    for i in range(size):
+        listing = dict(rows[i % len(rows)], uid=str(i))
+        listing['link'] = 'https://www.tori.fi/benchmark/listing_{}.htm'.format(i)
+        listing['price'] = int(rng.lognormvariate(4.5, 1.5))
+        catalogue.append(listing)
+    return catalogue
+
+
+def serve(catalogue, fetched):
+    """
+    Replaces downloading of the results pages with the catalogue filtered by the price options of the url
+    """
+    async def get_listings_page(page_url):
+        fetched.append(page_url)
+        query = {name: int(value) for name, value in QUERY_RE.findall(page_url)}
+        low = PRICE_BUCKETS[query['ps']] if 'ps' in query else None
+        high = PRICE_BUCKETS[query['pe']] if 'pe' in query else None
+        matching = [listing for listing in catalogue if (low is None or listing['price'] >= low) and
+                    (high is None or listing['price'] <= high)]
+        page = query['o']
+        return matching[(page - 1) * MAX_ITEMS_ON_PAGE:page * MAX_ITEMS_ON_PAGE]
+    parsing.get_listings_page = get_listings_page
+
+
+async def count_pages(fetched, min_price, max_price, max_items):
+    fetched.clear()
+    _, goods = await parsing.list_announcements(min_price=min_price, max_price=max_price, max_items=max_items,
+                                                prefetch=False, ignore_logs=True)
+    return len(fetched), len(goods)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Benchmark pushing price filters into the tori.fi query')
+    arg_parser.add_argument('--listings', type=int, default=2000, help='size of the simulated catalogue')
+    arg_parser.add_argument('--max-items', type=int, default=5, help='listings requested by every search')
+    arg_parser.add_argument('--seed', type=int, default=1)
+    args = arg_parser.parse_args()
+
+    parsing.logger.setLevel(logging.ERROR)  # unknown bid types in fixtures are expected
+    fetched = []
+    serve(load_catalogue(args.listings, args.seed), fetched)
+    print('{:<14} {:>8} {:>16} {:>15}'.format('price range', 'found', 'pages, local', 'pages, pushdown'))
+    totals = [0, 0]
+    for min_price, max_price in PRICE_RANGES:
+        pages = []
+        for pushdown in (False, True):
+            parsing.PRICE_PUSHDOWN = pushdown
+            count, found = asyncio.run(count_pages(fetched, min_price, max_price, args.max_items))
+            pages.append(count)
+        totals = [total + count for total, count in zip(totals, pages)]
+        price_range = '{}-{}'.format('' if min_price is None else min_price, '' if max_price is None else max_price)
+        print('{:<14} {:>8} {:>16} {:>15}'.format(price_range, found, *pages))
+    print('{:<14} {:>8} {:>16} {:>15}'.format('total', '', *totals))
+
+
+if __name__ == '__main__':
+    main()
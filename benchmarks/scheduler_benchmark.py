@@ -0,0 +1,85 @@
+"""
+Benchmark of the tracker scheduler: cost of adding and removing trackers and of the scheduler ticks with many
+active trackers. Expiries are spread over MAX_TRACKING_TIME and first polls over TRACKING_INTERVAL, the same as
+after the restart of the bot.
+
+Run from the repository root:
+    python benchmarks/scheduler_benchmark.py
+    python benchmarks/scheduler_benchmark.py --trackers 100000 --groups 5000
+"""
+import argparse
+import itertools
+import os
+import random
+import sys
+import time
+
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from constants import (CATEGORIES, LOCATION_OPTIONS, MAX_TRACKING_TIME, TRACKER_BATCH, TRACKER_TICK,  # noqa: E402
+                       TRACKING_INTERVAL)
+from parsing import SearchSpec  # noqa: E402
+from scheduler import Tracker, TrackerScheduler  # noqa: E402
+
+
+def make_trackers(count, groups, seed):
+    rng = random.Random(seed)
+    now = datetime.now(timezone.utc)
+    # trackers of a group differ only in keywords, groups differ in locations and categories
+    searches = itertools.product(itertools.combinations(LOCATION_OPTIONS, 2), CATEGORIES)
+    specs = [SearchSpec(locations=list(locations), category=category)
+             for locations, category in itertools.islice(searches, groups)]
+    trackers = []
+    for i in range(count):
+        spec = specs[i % len(specs)].replace(search_term='term {}'.format(i % 50))
+        trackers.append(Tracker('tracker_{}'.format(i), spec, i, 'user', i, '', now,
+                                now + timedelta(seconds=rng.uniform(0, MAX_TRACKING_TIME))))
+    return trackers
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Benchmark the tracker scheduler')
+    arg_parser.add_argument('--trackers', type=int, default=100000, help='number of active trackers')
+    arg_parser.add_argument('--groups', type=int, default=5000, help='number of polling groups')
+    arg_parser.add_argument('--seed', type=int, default=1)
+    args = arg_parser.parse_args()
+
+    trackers = make_trackers(args.trackers, args.groups, args.seed)
+    rng = random.Random(args.seed)
+    scheduler = TrackerScheduler(TRACKING_INTERVAL)
+    started = time.perf_counter()
+    for tracker in trackers:
+        scheduler.add(tracker, first=rng.uniform(0, TRACKING_INTERVAL))
+    add_seconds = time.perf_counter() - started
+
+    # ticks of one polling interval, the groups that are due are popped in batches
+    now = time.time()
+    ticks = int(TRACKING_INTERVAL / TRACKER_TICK)
+    polled = 0
+    tick_seconds = []
+    for i in range(1, ticks + 1):
+        started = time.perf_counter()
+        scheduler.expired(now + i * TRACKER_TICK)
+        polled += len(scheduler.due_groups(TRACKER_BATCH, now + i * TRACKER_TICK))
+        tick_seconds.append(time.perf_counter() - started)
+
+    removed = trackers[::10]
+    started = time.perf_counter()
+    for tracker in removed:
+        scheduler.remove(tracker.name)
+    remove_seconds = time.perf_counter() - started
+
+    print('trackers: {}, groups: {}, tracker record: {} bytes'.format(args.trackers, len(scheduler.groups),
+                                                                      sys.getsizeof(trackers[0])))
+    print('{:<10} {:>10} {:>14}'.format('operation', 'count', 'us/operation'))
+    print('{:<10} {:>10} {:>14.2f}'.format('add', len(trackers), add_seconds * 1e6 / len(trackers)))
+    print('{:<10} {:>10} {:>14.2f}'.format('tick', ticks, sum(tick_seconds) * 1e6 / ticks))
+    print('{:<10} {:>10} {:>14.2f}'.format('max tick', ticks, max(tick_seconds) * 1e6))
+    print('{:<10} {:>10} {:>14.2f}'.format('remove', len(removed), remove_seconds * 1e6 / len(removed)))
+    print('groups polled during the interval: {}'.format(polled))
+
+
+if __name__ == '__main__':
+    main()
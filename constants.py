@@ -24,6 +24,7 @@ FIN_MON_ABBREVS = {
     'mar': 'marraskuuta',  # november
     'jou': 'joulukuuta'  # december
     }
+EN_MON_ABBREVS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
 TODAY = 'tänään'
 YESTERDAY = 'eilen'
 
@@ -139,6 +140,9 @@ CATEGORIES = {
     'Any Category': 'cg=0'
 }
 
+# listing ids derived from tori.fi urls, old saved listings still have uuid ids
+LISTING_ID_PATTERN = '[a-f0-9-]{1,36}'
+
 BID_TYPES_TRANSLATIONS = {
     'Myydään': 'For Sale',
     'Ostetaan': 'Wanted to Buy',
@@ -194,8 +198,8 @@ INSERT_USER_SQL = '''
 INSERT_LISTING_SQL = '''
     INSERT INTO favourites (id, user_id, url, title, price, image_url, item_added, listing_type, is_deleted)
     VALUES ('{}', '{}', '{}', '{}', '{}', '{}', '{}', '{}', FALSE)
-    ON CONFLICT (url) DO UPDATE SET
-    (user_id, url, title, price, image_url, item_added, listing_type, is_deleted) = (EXCLUDED.user_id, EXCLUDED.url,
+    ON CONFLICT (user_id, id) DO UPDATE SET
+    (url, title, price, image_url, item_added, listing_type, is_deleted) = (EXCLUDED.url,
      EXCLUDED.title, EXCLUDED.price, EXCLUDED.image_url, EXCLUDED.item_added, EXCLUDED.listing_type, 
      EXCLUDED.is_deleted);
      SELECT url, title, price, image_url, item_added, listing_type, id FROM favourites 
@@ -213,6 +217,26 @@ DELETE_LISTING_SQL = '''
     WHERE user_id = '{}' and is_deleted = FALSE;
 '''
 
+INSERT_TRACKER_SQL = '''
+    INSERT INTO trackers (name, user_id, chat_id, username, spec, beautiful_params, watermark, created_at, expires_at)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s);
+'''
+
+UPDATE_TRACKER_WATERMARKS_SQL = '''
+    UPDATE trackers SET watermark = data.watermark::jsonb FROM (VALUES %s) AS data (name, watermark)
+    WHERE trackers.name = data.name;
+'''
+
+DELETE_TRACKERS_SQL = '''
+    DELETE FROM trackers WHERE name = ANY(%s);
+'''
+
+LIST_TRACKERS_SQL = '''
+    DELETE FROM trackers WHERE expires_at <= NOW();
+    SELECT name, user_id, chat_id, username, spec, beautiful_params, watermark, created_at, expires_at FROM trackers
+    ORDER BY created_at;
+'''
+
 DEFAULT_SETTINGS = {
     LOCATION: ['Tampere'],
     TYPE_OF_LISTING: ['For Sale', 'Free'],
@@ -235,13 +259,50 @@ LANGUAGES_MAPPING = {
 
 URL = 'https://www.tori.fi/'
 
+REQUEST_TIMEOUT = 10  # seconds
+REQUEST_CONNECT_TIMEOUT = 5  # seconds
+MAX_CONNECTIONS = 50
+MAX_KEEPALIVE_CONNECTIONS = 20
+MAX_CONNECTIONS_PER_HOST = 20
+MAX_BACKGROUND_CONNECTIONS_PER_HOST = 15  # held by tracker polls at most, the rest are kept for the user requests
+KEEPALIVE_EXPIRY = 30  # seconds
+
+HTML_PARSER = 'lxml'  # 'lxml' - fast extractor, 'html5lib' - reference BeautifulSoup extractor
+PARSE_WORKERS = int(os.getenv('PARSE_WORKERS', 0))  # processes extracting pages off the event loop, 0 - inline
+PARSER_COMPAT_CHECK = os.getenv('PARSER_COMPAT_CHECK') == '1'  # compare lxml extractor output with html5lib one
+
 BACK_BTN = 'Back to Menu \u21a9'
 CONFIRM_BTN = 'Confirm \U0001F680'
 
 MAX_ITEMS_PER_SEARCH = 5
 MAX_ITEMS_ON_PAGE = 40
-SEND_NOTIFICATIONS = False
+# upper bounds of the tori.fi price options in euros, index of the option is the value of ps= (min) and pe= (max)
+PRICE_BUCKETS = [0, 25, 50, 75, 100, 250, 500, 1000, 2500, 5000, 10000]
+# narrow the tori.fi query with the price options, exact price filtering is still done locally.
+# Off until PRICE_BUCKETS and the numbering of the options (the old note says pe=3 is the third one) are checked
+# against the live site, wrong bounds would drop valid listings before the local filter
+PRICE_PUSHDOWN = os.getenv('PRICE_PUSHDOWN') == '1'
+MAX_CONCURRENT_PAGES = 4  # max number of result pages of one search fetched at once
+RESULTS_CACHE_TTL = int(os.getenv('RESULTS_CACHE_TTL', 60))  # seconds parsed results page is shared between users
+RESULTS_CACHE_SIZE = int(os.getenv('RESULTS_CACHE_SIZE', 500))  # max number of cached results pages
+DETAILS_CACHE_TTL = int(os.getenv('DETAILS_CACHE_TTL', 60 * 5))  # seconds parsed listing page is cached
+UNAVAILABLE_CACHE_TTL = int(os.getenv('UNAVAILABLE_CACHE_TTL', 60 * 30))  # seconds removed listing is remembered
+DETAILS_CACHE_SIZE = int(os.getenv('DETAILS_CACHE_SIZE', 2000))  # max number of cached listing pages
+STREAM_CHUNK_SIZE = 16 * 1024  # bytes of the streamed results page fed to the parser at once
+FINGERPRINT_ROWS = 10  # number of the first listings compared to detect changes of the tracked results page
 
-TRACKING_INTERVAL = 60 * 20  # 20 minutes
+TRACKING_INTERVAL = 60 * 20  # 20 minutes, poll interval of the search until its listing rate is known
+MIN_TRACKING_INTERVAL = int(os.getenv('MIN_TRACKING_INTERVAL', 60 * 5))  # poll interval of the busiest searches
+MAX_TRACKING_INTERVAL = int(os.getenv('MAX_TRACKING_INTERVAL', 60 * 60))  # poll interval of the quiet searches
+POLL_TARGET_LISTINGS = 10  # new listings expected by one poll, the poll interval of the search is adjusted to it
+POLL_RATE_SMOOTHING = 0.5  # weight of the last poll in the estimated listing rate of the search
+POLL_JITTER = 0.2  # fraction of the poll interval every poll is moved by at random
+TRACKER_TICK = 10  # seconds between the ticks of the tracker scheduler
+METRICS_INTERVAL = int(os.getenv('METRICS_INTERVAL', 60 * 15))  # seconds between the logged metrics, 0 - off
+TRACKER_BATCH = int(os.getenv('TRACKER_BATCH', 100))  # max number of tracker groups polled concurrently
 MAX_SAVED_LISTINGS = 60  # 60 listings saved per user
 MAX_TRACKING_TIME = 60 * 60 * 48  # 48 hours
+MAX_WATERMARK_PAGES = 5  # max number of results pages scanned by one tracker poll
+WATERMARK_IDS = 100  # number of the most recently notified listings every tracker remembers
+BROAD_FETCH = os.getenv('BROAD_FETCH', '1') == '1'  # let keyword trackers share the search without keywords
+SEARCH_PLAN_TTL = 60 * 60 * 6  # seconds the estimated listing rate of the search without keywords is trusted
@@ -0,0 +1,286 @@
+import lxml.html
+import re
+
+from bs4 import BeautifulSoup, NavigableString
+from bs4.dammit import EncodingDetector
+from constants import BID_TYPES_TRANSLATIONS
+from lxml import etree
+from lxml.etree import ParserError
+
+"""
+Extractors of the raw fields from tori.fi pages.
+Every extractor returns plain strings only, converting them into dates/prices is done in parsing.py.
+The lxml extractors are the fast path, the BeautifulSoup (html5lib) ones are kept as a reference for compatibility
+checks.
+
+Results page row: {'title', 'link', 'date', 'price', 'bid_type', 'image'}
+Listing page: {'title', 'date', 'bid_type', 'price', 'location', 'description', 'image'}
+"""
+
+
+LIST_XPATH = "//div[contains(concat(' ', normalize-space(@class), ' '), ' list_mode_thumb ')][1]"
+ROW_XPATH = ".//a[contains(concat(' ', normalize-space(@class), ' '), ' item_row_flex ')]"
+ENCODING_SNIFF_BYTES = 2048  # the part of the page EncodingDetector searches for the encoding declaration
+
+
+def string_cleaner(string):
+    return re.sub(r'\s\s+', ' ', string.replace('\n', ' ')).strip()
+
+
+def string_retriever(tag):
+    """
+    Retrieves only strings from the tag. Does not go deeper than base level
+    :param tag:
+    :return: list[str]
+    """
+    return [string_cleaner(str(el.string)) for el in tag.contents if isinstance(el, NavigableString)
+            and not el.string.startswith('<') and string_cleaner(el.string)]
+
+
+def _has_class(class_name):
+    return "contains(concat(' ', normalize-space(@class), ' '), ' {} ')".format(class_name)
+
+
+def _first(el, xpath):
+    found = el.xpath(xpath)
+    return found[0] if found else None
+
+
+def _text(el):
+    return el.text_content() if el is not None else ''
+
+
+def _lxml_string_retriever(el):
+    """
+    lxml version of string_retriever
+    """
+    strings = [el.text]
+    for child in el:
+        if not isinstance(child.tag, str):  # comments are strings in bs4
+            strings.append(child.text)
+        strings.append(child.tail)
+    return [string_cleaner(s) for s in strings if s and not s.startswith('<') and string_cleaner(s)]
+
+
+_html_parsers = {}
+
+
+def _encoding(content):
+    """
+    Declared encoding of the page. Pages without declaration are utf-8 or windows-1252, the same as html5lib guesses
+    """
+    encoding = EncodingDetector.find_declared_encoding(content, is_html=True)
+    if encoding:
+        return encoding
+    try:
+        content.decode('utf-8')
+        return 'utf-8'
+    except UnicodeDecodeError:
+        return 'windows-1252'
+
+
+def _document(content):
+    try:
+        encoding = _encoding(content)
+        if encoding not in _html_parsers:
+            _html_parsers[encoding] = lxml.html.HTMLParser(encoding=encoding)
+        return lxml.html.fromstring(content, parser=_html_parsers[encoding])
+    except (ParserError, ValueError):
+        return None
+
+
+def extract_rows(content, skip=0):
+    """
+    Extracts rows of the results page with lxml. Only the 'list_mode_thumb' block is visited
+    :param content: bytes of the page
+    :param skip: number of rows at the top of the page to skip
+    :return: list[dict]
+    """
+    doc = _document(content)
+    if doc is None:
+        return []
+    list_of_goods = _first(doc, LIST_XPATH)
+    if list_of_goods is None:
+        return []
+    return [_extract_row(listing) for listing in list_of_goods.xpath(ROW_XPATH)[skip:]]
+
+
+def _extract_row(listing):
+    bid_type = None
+    cat_geo = _first(listing, ".//div[{}]".format(_has_class('cat_geo')))
+    for child in (cat_geo if cat_geo is not None else []):
+        if isinstance(child.tag, str) and child.text_content().strip() in BID_TYPES_TRANSLATIONS:
+            bid_type = child.text_content().strip()
+            break
+    img = _first(listing, ".//img[{}]".format(_has_class('item_image')))
+    return {
+        'title': _text(_first(listing, ".//div[{}]".format(_has_class('li-title')))),
+        'link': listing.get('href'),
+        'date': string_cleaner(_text(_first(listing, ".//div[{}]".format(_has_class('date_image'))))),
+        'price': _text(_first(listing, ".//p[normalize-space(@class)='list_price ineuros']")).strip(),
+        'bid_type': bid_type,
+        'image': img.get('src') if img is not None else None,
+    }
+
+
+class RowStreamExtractor:
+    """
+    Incremental version of extract_rows. Chunks of the page are fed as they are downloaded and every row is
+    extracted as soon as its closing tag is parsed, so the rest of the page does not have to be read.
+    The parser is created once ENCODING_SNIFF_BYTES are buffered, the encoding declaration is searched in them
+    """
+
+    def __init__(self):
+        self.parser = None
+        self.buffer = b''
+
+    def _start(self):
+        self.parser = etree.HTMLPullParser(events=('end',), tag='a', encoding=_encoding(self.buffer))
+        self.parser.set_element_class_lookup(lxml.html.HtmlElementClassLookup())
+        self.parser.feed(self.buffer)
+        self.buffer = b''
+
+    def _rows(self):
+        rows = []
+        for _, el in self.parser.read_events():
+            if 'item_row_flex' not in (el.get('class') or '').split():
+                continue
+            if any('list_mode_thumb' in (div.get('class') or '').split() for div in el.iterancestors('div')):
+                rows.append(_extract_row(el))
+            el.clear()
+        return rows
+
+    def feed(self, chunk):
+        """
+        :return: list[dict] of the rows completed by this chunk
+        """
+        if self.parser is None:
+            self.buffer += chunk
+            if len(self.buffer) < ENCODING_SNIFF_BYTES:
+                return []
+            self._start()
+        else:
+            self.parser.feed(chunk)
+        return self._rows()
+
+    def close(self):
+        """
+        :return: list[dict] of the rows left in the parser
+        """
+        if self.parser is None:
+            if not self.buffer:
+                return []
+            self._start()
+        try:
+            self.parser.close()
+        except etree.XMLSyntaxError:
+            pass
+        return self._rows()
+
+
+def extract_rows_bs4(content, skip=0):
+    """
+    Extracts rows of the results page with BeautifulSoup and html5lib
+    :param content: bytes of the page
+    :param skip: number of rows at the top of the page to skip
+    :return: list[dict]
+    """
+    soup = BeautifulSoup(content, 'html5lib')
+    list_of_goods = soup.find('div', class_='list_mode_thumb')
+    if not list_of_goods:
+        return []
+    rows = []
+    for listing in list_of_goods.findAll('a', attrs={'class': 'item_row_flex'})[skip:]:
+        bid_type = None
+        for child in listing.find('div', class_='cat_geo').findChildren(recursive=False):
+            if child.text and child.text.strip() in BID_TYPES_TRANSLATIONS:
+                bid_type = child.text.strip()
+                break
+        img = listing.find('img', class_='item_image')
+        rows.append({
+            'title': listing.find('div', class_='li-title').text,
+            'link': listing['href'],
+            'date': string_cleaner(listing.find('div', class_='date_image').text),
+            'price': listing.find('p', class_='list_price ineuros').text.strip(),
+            'bid_type': bid_type,
+            'image': img['src'] if img else None,
+        })
+    return rows
+
+
+def extract_details(content):
+    """
+    Extracts fields of the listing page with lxml
+    :param content: bytes of the page
+    :return: dict, None if the page is not a listing page or {} if the listing is no longer available
+    """
+    doc = _document(content)
+    if doc is None:
+        return None
+    listing = _first(doc, "//div[{}][1]".format(_has_class('content')))
+    if listing is None:
+        return None
+    table_info = _first(listing, ".//table[{}]".format(_has_class('tech_data')))
+    if table_info is None:
+        return {}
+    date = _first(table_info, ".//td[.='Ilmoitus jätetty:']/following::td[1]")
+    bid_type = _first(table_info, ".//td[.='Ilmoitustyyppi:']/following::td[1]")
+
+    price = _first(listing, ".//div[{}]//span".format(_has_class('price')))
+    if len(price) and ((price.text or '').strip() or len(price) > 1):
+        price = _first(price, ".//span")
+
+    img = _first(listing, ".//img[@id='main_image']")
+    return {
+        'title': string_cleaner(_text(_first(listing, ".//div[{}]//h1".format(_has_class('topic'))))),
+        'date': string_cleaner(_text(date)),
+        'bid_type': string_cleaner(_text(bid_type)) if bid_type is not None else None,
+        'price': _text(price).strip(),
+        'location': _lxml_string_retriever(_first(listing, ".//div[@id='seller_info']//div")),
+        'description': '\n'.join(_lxml_string_retriever(_first(listing, ".//div[{}]".format(_has_class('body'))))),
+        'image': img.get('src'),
+    }
+
+
+def extract_details_bs4(content):
+    """
+    Extracts fields of the listing page with BeautifulSoup and html5lib
+    :param content: bytes of the page
+    :return: dict, None if the page is not a listing page or {} if the listing is no longer available
+    """
+    soup = BeautifulSoup(content, 'html5lib')
+    listing = soup.find('div', class_='content')
+    if not listing:
+        return None
+    table_info = listing.find('table', class_='tech_data')
+    if not table_info:
+        return {}
+    bid_type_el = table_info.find('td', string='Ilmoitustyyppi:')
+    price = listing.find('div', class_='price').span
+    return {
+        'title': string_cleaner(listing.find('div', class_='topic').h1.text),
+        'date': string_cleaner(table_info.find('td', string='Ilmoitus jätetty:').findNext('td').text),
+        'bid_type': string_cleaner(bid_type_el.findNext('td').text) if bid_type_el else None,
+        'price': price.text.strip() if price.string else price.span.text.strip(),
+        'location': string_retriever(listing.find('div', id='seller_info').div),
+        'description': '\n'.join(string_retriever(listing.find('div', class_='body'))),
+        'image': listing.find('img', id='main_image')['src'],
+    }
+
+
+def compare_extracted(fast, reference):
+    """
+    Compares output of the fast extractor with the reference one
+    :return: list[str] of the differences, empty if outputs are equal
+    """
+    if isinstance(fast, list) and isinstance(reference, list):
+        diffs = []
+        if len(fast) != len(reference):
+            diffs.append('rows: {} != {}'.format(len(fast), len(reference)))
+        for i, (row, ref_row) in enumerate(zip(fast, reference)):
+            diffs.extend('row {}: {}'.format(i, diff) for diff in compare_extracted(row, ref_row))
+        return diffs
+    if isinstance(fast, dict) and isinstance(reference, dict):
+        return ['{}: {!r} != {!r}'.format(k, fast.get(k), reference.get(k)) for k in sorted(set(fast) | set(reference))
+                if fast.get(k) != reference.get(k)]
+    return [] if fast == reference else ['{!r} != {!r}'.format(fast, reference)]
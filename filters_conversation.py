@@ -530,7 +530,7 @@ async def end(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         await context.bot.send_message(text='Searching for {} items{} in {} region..'
                                        .format(search_params.get('bid_type'), query_phrase, loc_str), chat_id=chat_id)
     print('--', search_params, len(context.user_data['items']) if context.user_data.get('items') else 'P', starting_ind)
-    finished_on, items = list_announcements(**search_params, starting_ind=starting_ind)
+    finished_on, items = await list_announcements(**search_params, starting_ind=starting_ind)
     if not items:
         await context.bot.send_message(text='Sorry, no items were found with these filters', chat_id=chat_id)
         return ConversationHandler.END
@@ -577,7 +577,7 @@ async def more_info_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         return
 
     # print(9999999999999999999999999, query.data, type(query.data))
-    listing = listing_info(user_data['items'][int(query.data)]['link'])
+    listing = await listing_info(user_data['items'][int(query.data)]['link'])
     maps_url = 'https://www.google.com/maps/place/' + listing['location'][-1].replace(' ', '+')
     logger.info('Listing url: {}'.format(listing['link']))
     # logger.info('Listing title: {}', listing['title'][0])
@@ -621,7 +621,7 @@ async def collect_data(context: ContextTypes.DEFAULT_TYPE):
     logger.info('User %s is tracking: %s, %s, %s', user_data['username'] or user_data['first_name'],
                 user_data.get(LOCATION), user_data.get(TYPE_OF_LISTING), user_data.get(QUERY))
     utc_time_now = datetime.now(timezone.utc)
-    prum, items = list_announcements(**user_data, max_items=TRACKING_INTERVAL / 60)
+    prum, items = await list_announcements(**user_data, max_items=TRACKING_INTERVAL / 60)
     items = list(filter(lambda x: x['date'] > (utc_time_now - timedelta(seconds=TRACKING_INTERVAL)), items))
     if not items:
         logger.info('No new items found')
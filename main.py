@@ -1,16 +1,20 @@
+import asyncio
 import copy
-import locale
 import psycopg2
-import pytz
 import translators.server as tss
 
 from constants import *
 from datetime import datetime, timedelta, timezone
 from parsing import (beautify_items, list_announcements, listing_info, beautify_listing, params_beautifier, logger,
-                     parse_psql_listings, get_saved_from_db, generate_unique_job_name)
+                     parse_psql_listings, get_saved_from_db, generate_unique_job_name, close_http_client,
+                     format_date, poll_search, remember_listings, find_listing, close_parse_pool,
+                     scan_new_listings, SearchSpec, metrics, compile_keywords, search_rate, prefer_broad_fetch,
+                     poll_interval, save_tracker, save_watermarks, delete_trackers, load_trackers,
+                     background_requests, get_metrics, PageUnavailableError)
+from scheduler import Tracker, TrackerScheduler
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update, BotCommand
 from telegram.constants import ParseMode
-from telegram.error import BadRequest, NetworkError
+from telegram.error import BadRequest, NetworkError, TelegramError
 from telegram.ext import (Application, CallbackQueryHandler, ContextTypes, ConversationHandler,
                           CommandHandler, MessageHandler, filters)
 from telegram.warnings import PTBUserWarning
@@ -68,16 +72,10 @@ def tori_wrapper(log=False, db_update=False):
 
 
 async def post_init(application: Application) -> None:
-    if SEND_NOTIFICATIONS:
-        chat_ids = [chat.id for chat in application.bot.get_updates()[-1].effective_chat.all_members]
-        # iterate through the chat IDs and send a message to each user
-        for chat_id in chat_ids:
-            await application.bot.send_message(chat_id=chat_id,
-                                               text='The bot has been updated!\nAll of the running trackers'
-                                                    ' were killed, so consider setting them up again.')
-    # await application.bot.send_message(chat_id=386593171,
-    #                                    text='The bot has been updated!\nAll of the running trackers'
-    #                                         ' were killed, so consider setting them up again.')
+    restore_trackers(application)
+    application.job_queue.run_repeating(dispatch_trackers, TRACKER_TICK, name='tracker_scheduler')
+    if METRICS_INTERVAL:
+        application.job_queue.run_repeating(log_metrics, METRICS_INTERVAL, name='metrics')
 
     # set commands
     await application.bot.delete_my_commands()
@@ -91,6 +89,19 @@ async def post_init(application: Application) -> None:
     await application.bot.set_my_commands(command)  # rules-bot
 
 
+async def log_metrics(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Logs the cache, tracker and request queue counters
+    """
+    logger.info('Metrics: {}'.format(', '.join('{}={}'.format(name, round(value, 3) if isinstance(value, float) else
+                                                              value) for name, value in sorted(get_metrics().items()))))
+
+
+async def post_shutdown(application: Application) -> None:
+    await close_http_client()
+    close_parse_pool()
+
+
 @tori_wrapper(log=True, db_update=True)
 async def help_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info('Might need help.')
@@ -651,9 +662,9 @@ async def start_searching(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     End conversation and start the search.
     """
     user = update.message.from_user if update.message else update.callback_query.from_user
-    context.user_data['saved'] = get_saved_from_db(user.id, context.user_data.get('saved', []))
-    search_params = copy.deepcopy(context.user_data.get(FEATURES, DEFAULT_SETTINGS))
-    beautiful_params = params_beautifier(search_params)
+    context.user_data['saved'] = get_saved_from_db(user.id, context.user_data.get('saved'))
+    features = context.user_data.get(FEATURES, DEFAULT_SETTINGS)
+    beautiful_params = params_beautifier(features)
     chat_id = update.effective_chat.id
     query = update.callback_query
     try:
@@ -661,23 +672,24 @@ async def start_searching(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         if query.data.endswith('show_more'):
             await update.callback_query.edit_message_text(text='Showing more listings:')
             starting_ind = int(query.data.split('_')[0])
-            search_params['ignore_logs'] = True
+            ignore_logs = True
         else:
             starting_ind = 0
-            search_params['ignore_logs'] = False
+            ignore_logs = False
     except AttributeError as e:
         starting_ind = 0
-        search_params['ignore_logs'] = False
-    if not search_params:
+        ignore_logs = False
+    if not features:
         logger.error('User %s tried to start a search but no data was provided',
                      user.username or user.first_name or user.id)
         await context.bot.send_message(text='Sorry, your old search history was deleted. Try to search again.',
                                        chat_id=chat_id)
         return END
-    if search_params.get(QUERY) and context.user_data[QUERY_LANGUAGE] != 'Finnish':
-        search_params[QUERY] = tss.google(search_params[QUERY],
-                                          from_language=LANGUAGES_MAPPING[context.user_data[QUERY_LANGUAGE]],
-                                          to_language='fi')
+    spec = SearchSpec.from_params(**features)
+    if spec.search_term and context.user_data[QUERY_LANGUAGE] != 'Finnish':
+        spec = spec.replace(search_term=tss.google(spec.search_term,
+                                                   from_language=LANGUAGES_MAPPING[context.user_data[QUERY_LANGUAGE]],
+                                                   to_language='fi'))
     if not starting_ind:
         logger.info('User {} is searching from item №{}:\n{}'.format(user.username or user.first_name or user.id,
                                                                      starting_ind, beautiful_params))
@@ -687,19 +699,17 @@ async def start_searching(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         logger.info('User {} is continuing searching from item №{}'.format(user.username or user.first_name or user.id,
                                                                            starting_ind))
     await context.bot.send_chat_action(chat_id=chat_id, action='typing')
-    finished_on, items = list_announcements(**search_params, starting_ind=starting_ind)
+    if not starting_ind:
+        context.user_data['search_cursor'] = {}
+    finished_on, items = await list_announcements(spec, starting_ind=starting_ind, ignore_logs=ignore_logs, stream=True,
+                                                  cursor=context.user_data.setdefault('search_cursor', {}))
     if not items:
         await context.bot.send_message(text='Sorry, no items were found with these filters.', chat_id=chat_id)
         return END
-    if not context.user_data.get('items'):
-        context.user_data['items'] = items
-    else:
-        context.user_data['items'] = context.user_data['items'] + items
-    if len(context.user_data['items']) > MAX_SAVED_LISTINGS:
-        context.user_data['items'] = context.user_data['items'][-MAX_SAVED_LISTINGS:]
+    context.user_data['items'] = remember_listings(context.user_data.get('items'), items)
     beautified = beautify_items(items, lang=LANGUAGES_MAPPING[context.user_data.get(QUERY_LANGUAGE, 'English')])
 
-    saved_urls = [i['link'] for i in context.user_data.get('saved', [])]
+    saved_urls = {i['link'] for i in (context.user_data.get('saved') or {}).values()}
     if not starting_ind:
         await context.bot.send_message(text='Here you go! I hope you will find what you are looking for.',
                                        chat_id=chat_id)
@@ -747,13 +757,9 @@ async def more_info_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -
                            'Sorry, something went wrong.\nTry to use /search again.', show_alert=True)
         return
 
-    saved_items = user_data.get('saved') or []
-    reg_items = user_data.get('items') or []
-    unique_items = list(reg_items)
-    unique_items.extend(x for x in saved_items if x not in unique_items)
     item_uid = query.data[query.data.find('_') + 1:] if query.data.startswith('keep') else query.data
 
-    listing = [item for item in unique_items if item['uid'] == item_uid]
+    listing = find_listing(user_data, item_uid)
     if not listing:
         logger.warning('User %s tried to Show More Info on object that expired',
                        user.username or user.first_name or user.id)
@@ -761,10 +767,9 @@ async def more_info_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -
                            'Sorry, this object is no longer accessible.\nTry to use /search again.', show_alert=True)
         await query.message.delete()
         return
-    listing = listing[0]
     logger.info('More info url: {}'.format(listing['link']))
     listing_url = listing['link']
-    listing = listing_info(listing_url)
+    listing = await listing_info(listing_url)
     if type(listing) == str:
         if listing == listing_url:
             keyboard = InlineKeyboardMarkup([
@@ -780,7 +785,7 @@ async def more_info_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -
             await query.message.delete()
             return
     maps_url = 'https://www.google.com/maps/place/' + listing['location'][-1].replace(' ', '+')
-    saved_urls = [i['link'] for i in context.user_data.get('saved', [])]
+    saved_urls = {i['link'] for i in (context.user_data.get('saved') or {}).values()}
     if listing_url in saved_urls and not query.data.startswith('keep'):
         saved_btn = InlineKeyboardButton('Remove from Saved \u274c', callback_data='rm-item_' + item_uid)
     elif listing_url in saved_urls:
@@ -806,36 +811,185 @@ async def more_info_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -
                                       reply_markup=reply_markup)
 
 
-@tori_wrapper()
-async def collect_data(context: ContextTypes.DEFAULT_TYPE):
+def tracker_scheduler(context) -> TrackerScheduler:
     """
-    Collects data and sends message if new item has appeared on tori
+    Ongoing trackers of all of the chats, indexed by chat. Trackers with the same location, type and category share one
+    polling group
+    :param context: CallbackContext or Application
     """
-    job = context.job
-    user_data = job.data
-    beautiful_params = user_data['beautiful_params']
+    if 'scheduler' not in context.bot_data:
+        context.bot_data['scheduler'] = TrackerScheduler(TRACKING_INTERVAL, jitter=POLL_JITTER)
+    return context.bot_data['scheduler']
 
-    if not user_data:
-        logger.error('User %s tried to start a search but no data was provided', user_data['user'])
+
+def restore_trackers(application: Application):
+    """
+    Restores the stored trackers after restart. First polls of the groups are spread over TRACKING_INTERVAL,
+    so tori.fi is not requested for all of them at once
+    """
+    try:
+        trackers = [Tracker(**row, ignore_logs=True) for row in load_trackers()]
+    except psycopg2.Error as e:
+        logger.error('Could not restore trackers: {}'.format(str(e)))
         return
+    groups = {group: i for i, group in enumerate(dict.fromkeys(tracker.group for tracker in trackers))}
+    scheduler = tracker_scheduler(application)
+    for tracker in trackers:
+        tracker.original_data = application.user_data[tracker.user_id]
+        scheduler.add(tracker, first=TRACKING_INTERVAL * (groups[tracker.group] + 1) / len(groups))
+    logger.info('Restored {} trackers in {} groups'.format(len(trackers), len(groups)))
 
-    utc_time_now = datetime.now(timezone.utc)
-    # one search per minute should be enough, so I've set max to 20-30 results per search
-    prum, items = list_announcements(**user_data, max_items=TRACKING_INTERVAL / 60)
-    user_data['ignore_logs'] = True
-    items = list(filter(lambda x: x['date'] > (utc_time_now - timedelta(seconds=TRACKING_INTERVAL)), items))
-    if not items:
+
+async def dispatch_trackers(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Tick of the tracker scheduler. Ends the expired trackers and starts the polls of the groups that are due, every
+    poll is a task of its own, so the tick returns at once and a slow group does not hold up the rest.
+    At most TRACKER_BATCH groups are polled at the same time, the rest are started by the next ticks
+    """
+    scheduler = tracker_scheduler(context)
+    polling = context.bot_data.setdefault('polling_groups', set())
+    expired = scheduler.expired()
+    if expired:
+        context.application.create_task(end_trackers(context, expired))
+    for group in scheduler.due_groups(max(TRACKER_BATCH - len(polling), 0)):
+        if group in polling:
+            metrics['tracker_polls_overlapped'] += 1
+            continue
+        polling.add(group)
+        context.application.create_task(run_poll(context, group, polling))
+
+
+async def run_poll(context: ContextTypes.DEFAULT_TYPE, group_name, polling):
+    """
+    Polls the group with the requests that yield to the requests of the users
+    :param polling: set of the groups being polled, the group is removed from it when the poll is over
+    """
+    try:
+        with background_requests():
+            await poll_group(context, group_name)
+    except Exception as e:
+        logger.error('Polling of {} has failed: {}'.format(group_name, repr(e)))
+    finally:
+        polling.discard(group_name)
+
+
+@tori_wrapper()
+async def poll_group(context: ContextTypes.DEFAULT_TYPE, group_name):
+    """
+    Polls the searches of the group once and sends new items to every tracker of the group.
+    Keywords of the trackers are either searched one by one or matched locally against the search without keywords,
+    whichever takes fewer requests. The next poll of the group is scheduled by the listing rate of its searches
+    """
+    scheduler = tracker_scheduler(context)
+    trackers = scheduler.group_trackers(group_name)
+    if not trackers:
         return
-    if not user_data['original_data'].get('items'):
-        user_data['original_data']['items'] = items
+    group = scheduler.group_data[group_name]
+
+    searches = {}
+    for tracker in trackers:
+        searches.setdefault(tracker.spec.replace(min_price=None, max_price=None), []).append(tracker)
+    broad_spec = trackers[0].spec.replace(search_term='', min_price=None, max_price=None)
+    now = datetime.now(timezone.utc)
+    if len(searches) > 1 and (group.get('rated_at') is None or
+                              (now - group['rated_at']).total_seconds() > SEARCH_PLAN_TTL):
+        group['rate'], group['rated_at'] = await search_rate(broad_spec), now
+
+    # listings per TRACKING_INTERVAL that appeared on the first pages since the previous poll, 0 if none changed
+    observed = 0.
+    advanced = {}  # tracker name -> (tracker, its watermark before the poll)
+    if len(searches) > 1 and prefer_broad_fetch(group.get('rate'), len(searches)):
+        metrics['broad_fetch_polls'] += 1
+        # without coalescing every tracker would have polled the search on its own
+        metrics['tracker_polls_coalesced'] += len(trackers) - 1
+        fingerprint = group['fingerprints'].setdefault(broad_spec.key, {})
+        previous = dict(fingerprint)
+        if await poll_search(fingerprint, broad_spec):
+            group['rate'], group['rated_at'] = await search_rate(broad_spec), now
+            observed = group['rate'] or 0.
+            matcher = compile_keywords({tracker.spec.search_term for tracker in trackers})
+            scanned = True
+            for tracker in trackers:
+                term = tracker.spec.search_term
+                scanned &= await scan_and_notify(context, tracker, advanced, tracker.spec.replace(search_term=''),
+                                                 match=lambda product: term in matcher(product['title']))
+            if not scanned:
+                group['fingerprints'][broad_spec.key] = previous
     else:
-        user_data['original_data']['items'] = user_data['original_data']['items'] + items
-    if len(user_data['original_data']['items']) > MAX_SAVED_LISTINGS:
-        user_data['original_data']['items'] = user_data['original_data']['items'][-MAX_SAVED_LISTINGS:]
-    beautified = beautify_items(items, lang=LANGUAGES_MAPPING[user_data.get(QUERY_LANGUAGE, 'English')])
+        metrics['tracker_polls_coalesced'] += len(trackers) - len(searches)
+        for spec, search_trackers in searches.items():
+            fingerprint = group['fingerprints'].setdefault(spec.key, {})
+            previous = dict(fingerprint)
+            if not await poll_search(fingerprint, spec):
+                continue
+            observed = max(observed, await search_rate(spec) or 0.)
+            scanned = True
+            for tracker in search_trackers:
+                scanned &= await scan_and_notify(context, tracker, advanced)
+            if not scanned:
+                group['fingerprints'][spec.key] = previous
+    await store_watermarks(advanced)
+
+    rate = group.get('poll_rate')
+    group['poll_rate'] = observed if rate is None else POLL_RATE_SMOOTHING * observed + (1 - POLL_RATE_SMOOTHING) * rate
+    scheduler.set_interval(group_name, poll_interval(group['poll_rate']))
+
+
+async def scan_and_notify(context: ContextTypes.DEFAULT_TYPE, tracker, advanced, spec=None, match=None):
+    """
+    Sends the new items of the tracker. The search of the tracker can be replaced with spec
+    :param advanced: dict, the tracker and its previous watermark are added to it when the watermark has moved
+    :return: False if the scan has not finished because a results page could not be downloaded, True otherwise
+    """
+    # the pages after the first one are downloaded by the first tracker, the rest get them from the cache
+    watermark = dict(tracker.watermark)
+    try:
+        items = await scan_new_listings(tracker.watermark, spec or tracker.spec, match=match,
+                                        ignore_logs=tracker.ignore_logs)
+    except PageUnavailableError as e:
+        # the watermark has not moved, the listings are scanned again by the next poll
+        metrics['tracker_scans_failed'] += 1
+        logger.warning('Scan of tracker {} has not finished, page {} is unavailable'.format(tracker.name, str(e)))
+        return False
+    tracker.ignore_logs = True
+    if tracker.watermark != watermark:
+        advanced[tracker.name] = (tracker, watermark)
+    if not items:
+        return True
+    try:
+        await notify_tracker(context, tracker, items)
+    except TelegramError as e:
+        logger.warning('Could not notify tracker of {}: {}'.format(tracker.user, str(e)))
+    return True
+
+
+async def store_watermarks(advanced):
+    """
+    Stores the moved watermarks of the polled trackers in one write off the event loop. If the write fails, the
+    watermarks are moved back, so the stored and the running trackers agree
+    :param advanced: dict filled by scan_and_notify
+    """
+    if not advanced:
+        return
+    trackers = [tracker for tracker, _ in advanced.values()]
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, save_watermarks, trackers)
+    except psycopg2.Error as e:
+        logger.error('Could not store watermarks of {} trackers: {}'.format(len(trackers), str(e)))
+        for tracker, watermark in advanced.values():
+            tracker.watermark = watermark
+
+
+async def notify_tracker(context: ContextTypes.DEFAULT_TYPE, tracker, items):
+    """
+    Sends new items found by the tracker
+    """
+    beautiful_params = tracker.beautiful_params
+    tracker.original_data['items'] = remember_listings(tracker.original_data.get('items'), items)
+    beautified = beautify_items(items, lang=LANGUAGES_MAPPING[tracker.original_data.get(QUERY_LANGUAGE, 'English')])
 
     text = 'New items have been found using the following parameters:\n\n{}'.format(beautiful_params)
-    await context.bot.send_message(job.chat_id, text=text)
+    await context.bot.send_message(tracker.chat_id, text=text)
     for i in range(len(items)):
         keyboard = [
             [
@@ -848,23 +1002,28 @@ async def collect_data(context: ContextTypes.DEFAULT_TYPE):
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
         try:
-            await context.bot.send_photo(chat_id=job.chat_id, photo=items[i]['image'],
+            await context.bot.send_photo(chat_id=tracker.chat_id, photo=items[i]['image'],
                                          caption=beautified[i], reply_markup=reply_markup, parse_mode='HTML')
         except BadRequest:
             logger.warning('Bad Image in tracker {}'.format(items[i]['image'] or 'None'))
-            await context.bot.send_message(chat_id=job.chat_id, text=beautified[i], reply_markup=reply_markup,
+            await context.bot.send_message(chat_id=tracker.chat_id, text=beautified[i], reply_markup=reply_markup,
                                            parse_mode='HTML')
 
 
-@tori_wrapper()
-async def track_end(context: ContextTypes.DEFAULT_TYPE) -> None:
+async def end_trackers(context: ContextTypes.DEFAULT_TYPE, trackers) -> None:
     """
-    Sends the message that informs about ended job.
+    Removes the ended trackers from db and informs their chats. The trackers are already removed from the scheduler
     """
-    job = context.job
-    user_data = job.data
-    await context.bot.send_message(job.chat_id, text='Tracking job with following parameters has ended:\n{}'
-                                   .format(user_data['beautiful_params']))
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, delete_trackers, [tracker.name for tracker in trackers])
+    except psycopg2.Error as e:
+        logger.error('Could not delete {} ended trackers: {}'.format(len(trackers), str(e)))
+    for tracker in trackers:
+        try:
+            await context.bot.send_message(tracker.chat_id, text='Tracking job with following parameters has ended:\n{}'
+                                           .format(tracker.beautiful_params))
+        except TelegramError as e:
+            logger.warning('Could not notify the end of tracker of {}: {}'.format(tracker.user, str(e)))
 
 
 @tori_wrapper(db_update=True)
@@ -873,24 +1032,21 @@ async def start_tracking(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     Stores the info about the user and ends the conversation.
     """
     user = update.message.from_user if update.message else update.callback_query.from_user
-    search_params = copy.deepcopy(context.user_data.get(FEATURES, DEFAULT_SETTINGS))
-    beautiful_params = params_beautifier(search_params)
-    search_params['beautiful_params'] = beautiful_params
-    search_params['user'] = user.username or user.first_name or user.id
-    search_params['original_data'] = context.user_data
-    search_params['ignore_logs'] = False
+    features = context.user_data.get(FEATURES, DEFAULT_SETTINGS)
+    beautiful_params = params_beautifier(features)
     chat_id = update.effective_chat.id
 
-    if not search_params:
+    if not features:
         logger.error('User %s tried to start a search but no data was provided',
                      user.username or user.first_name or user.id)
         await update.message.reply_text('Sorry, your old search history was deleted. Try to search again.')
         return END
 
-    if search_params.get(QUERY) and context.user_data[QUERY_LANGUAGE] != 'Finnish':
-        search_params[QUERY] = tss.google(search_params[QUERY],
-                                          from_language=LANGUAGES_MAPPING[context.user_data[QUERY_LANGUAGE]],
-                                          to_language='fi')
+    spec = SearchSpec.from_params(**features)
+    if spec.search_term and context.user_data[QUERY_LANGUAGE] != 'Finnish':
+        spec = spec.replace(search_term=tss.google(spec.search_term,
+                                                   from_language=LANGUAGES_MAPPING[context.user_data[QUERY_LANGUAGE]],
+                                                   to_language='fi'))
 
     logger.info('User {} started tracking:\n{}'.format(user.username or user.first_name or user.id, beautiful_params))
     # job_removed = remove_job_if_exists(str(chat_id), context)  # Need to support multiple jobs
@@ -901,14 +1057,19 @@ async def start_tracking(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
            '/list_trackers - to list all ongoing trackers\n\n' \
            'Active filters:\n{}'.format(beautiful_params)
 
+    scheduler = tracker_scheduler(context)
+    created_at = datetime.now(timezone.utc)
+    tracker = Tracker(generate_unique_job_name(scheduler.trackers, prefix='tracker_'), spec, chat_id,
+                      user.username or user.first_name or user.id, user.id, beautiful_params, created_at,
+                      created_at + timedelta(seconds=MAX_TRACKING_TIME), original_data=context.user_data)
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, save_tracker, tracker)
+    except psycopg2.Error as e:
+        logger.error('Could not store tracker of {}: {}'.format(tracker.user, str(e)))
+        await update.callback_query.edit_message_text(text='Sorry, the tracker could not be set up. Try again later.')
+        return END
+    scheduler.add(tracker)
     await update.callback_query.edit_message_text(text=text, parse_mode='HTML')
-    job_name = generate_unique_job_name(context.job_queue.jobs())
-
-    search_params['created_at'] = datetime.now(timezone.utc)
-    context.job_queue.run_repeating(collect_data, TRACKING_INTERVAL, chat_id=chat_id, last=MAX_TRACKING_TIME,
-                                    name='tracker_' + job_name, data=search_params)
-    context.job_queue.run_once(track_end, MAX_TRACKING_TIME, chat_id=chat_id,
-                               name='timer_' + job_name, data=search_params)
     return END
 
 
@@ -917,16 +1078,15 @@ async def unset(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Remove the job if the user changed their mind. Shows list of jobs
     """
-    jobs = [job for job in context.job_queue.jobs() if job.name.startswith('tracker_')]
-    if not jobs:
+    trackers = tracker_scheduler(context).chat_trackers(update.effective_chat.id)
+    if not trackers:
         await update.message.reply_text('There are no ongoing trackers.')
         return
 
-    locale.setlocale(locale.LC_TIME, 'en_US.UTF-8')
     reply_options = [[InlineKeyboardButton('\U0001F7E2 Created at: {}; {}'.format(
-        job.data['created_at'].astimezone(pytz.timezone('Europe/Helsinki')).strftime('%H:%M, %d %b'),
-        job.data['beautiful_params'].replace('\n', '; ')),
-        callback_data=job.name)] for job in jobs] + [[InlineKeyboardButton('Close \u274c',
+        format_date(tracker.created_at),
+        tracker.beautiful_params.replace('\n', '; ')),
+        callback_data=tracker.name)] for tracker in trackers] + [[InlineKeyboardButton('Close \u274c',
                                                                            callback_data=DELETE_MESSAGE)]]
 
     reply_markup = InlineKeyboardMarkup(reply_options)
@@ -944,16 +1104,19 @@ async def unset_tracker(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     # CallbackQueries need to be answered, even if no notification to the user is needed
     # Some clients may have trouble otherwise. See https://core.telegram.org/bots/api#callbackquery
     await query.answer()
-    job = context.job_queue.get_jobs_by_name(query.data)
-    if not job:
+    scheduler = tracker_scheduler(context)
+    tracker = scheduler.trackers.get(query.data)
+    if tracker is None or tracker.chat_id != update.effective_chat.id:
         logger.warning('User %s. Error while finding job to remove', user.username or user.first_name or user.id)
         return
-    job2 = context.job_queue.get_jobs_by_name('timer_' + query.data[query.data.index('_') + 1:])
-    if not job2:
-        logger.warning('User %s. Error while finding job timer to remove', user.username or user.first_name or user.id)
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, delete_trackers, [tracker.name])
+    except psycopg2.Error as e:
+        logger.error('Could not delete tracker of {}: {}'.format(tracker.user, str(e)))
+        await query.edit_message_text(text='Sorry, the tracker could not be removed. Try again later.')
         return
-    job[0].schedule_removal()
-    job2[0].schedule_removal()
+    # the group of the tracker is not polled anymore once its last tracker is gone
+    scheduler.remove(tracker.name)
 
     await update.callback_query.answer()
     await update.callback_query.edit_message_text(text='Tracker has been removed.')
@@ -964,8 +1127,7 @@ async def unset_all(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Ask to confirm all jobs unsetting
     """
-    jobs = context.job_queue.jobs()
-    if not jobs:
+    if not tracker_scheduler(context).chat_trackers(update.effective_chat.id):
         await update.message.reply_text('There are no ongoing trackers.')
         return
 
@@ -980,10 +1142,22 @@ async def unset_all(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 @tori_wrapper(log=True)
 async def unset_all_confirmed(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
-    Remove all ongoing jobs
+    Remove all ongoing jobs of the chat
     """
-    for job in context.job_queue.jobs():
-        job.schedule_removal()
+    scheduler = tracker_scheduler(context)
+    trackers = scheduler.chat_trackers(update.effective_chat.id)
+    if trackers:
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, delete_trackers,
+                                                             [tracker.name for tracker in trackers])
+        except psycopg2.Error as e:
+            logger.error('Could not delete trackers of chat {}: {}'.format(update.effective_chat.id, str(e)))
+            await update.callback_query.answer()
+            await update.callback_query.edit_message_text(text='Sorry, the trackers could not be removed. '
+                                                               'Try again later.')
+            return
+        for tracker in trackers:
+            scheduler.remove(tracker.name)
     await update.callback_query.answer()
     await update.callback_query.edit_message_text(text='All trackers were removed.')
 
@@ -993,17 +1167,16 @@ async def list_trackers(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     """
     Lists ongoing trackers
     """
-    jobs = [job for job in context.job_queue.jobs() if job.name.startswith('tracker_')]
-    if not jobs:
+    trackers = tracker_scheduler(context).chat_trackers(update.effective_chat.id)
+    if not trackers:
         await update.message.reply_text('There are no ongoing trackers.')
         logger.info('There are no ongoing trackers.')
         return
 
     text = 'The following trackers are running:'
-    locale.setlocale(locale.LC_TIME, 'en_US.UTF-8')
-    for job in jobs:
-        text += '\n\n\u2022 Created at: {}\n{}'.format(job.data['created_at'].astimezone(
-            pytz.timezone('Europe/Helsinki')).strftime('%H:%M, %d %b'), job.data['beautiful_params'])
+    for tracker in trackers:
+        text += '\n\n\u2022 Created at: {}\n{}'.format(format_date(tracker.created_at),
+                                                       tracker.beautiful_params)
     await update.message.reply_text(text)
 
 
@@ -1042,18 +1215,13 @@ async def add_to_saved(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
                                        chat_id=update.effective_chat.id)
         return
 
-    saved_items = user_data.get('saved') or []
-    reg_items = user_data.get('items') or []
-    unique_items = list(reg_items)
-    unique_items.extend(x for x in saved_items if x not in unique_items)
-    listing = [item for item in unique_items if item['uid'] == query.data[query.data.find('_') + 1:]]
+    listing = find_listing(user_data, query.data[query.data.find('_') + 1:])
     if not listing:
         logger.warning('User %s tried to save on object that expired', user.username or user.first_name or user.id)
         await query.answer('\u2757 Not available \u2757\n'
                            'Sorry, this object is no longer accessible.\nTry to use /search again.', show_alert=True)
         await query.message.delete()
         return
-    listing = listing[0]
     keyboard = InlineKeyboardMarkup([
         query.message.reply_markup.inline_keyboard[0],
         [InlineKeyboardButton('Remove from Saved \u274c', callback_data='keep-rm-item_' + listing['uid'])]
@@ -1086,8 +1254,8 @@ async def list_saved(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     if update.callback_query:
         await update.callback_query.answer()
 
-    items = get_saved_from_db(user.id, context.user_data.get('saved', []))
-    context.user_data['saved'] = items
+    context.user_data['saved'] = get_saved_from_db(user.id, context.user_data.get('saved'))
+    items = list(context.user_data['saved'].values())
     if not items:
         await context.bot.send_message(chat_id=chat_id, text='Your list of saved listings is empty.')
         return END
@@ -1130,18 +1298,13 @@ async def remove_from_saved(update: Update, context: ContextTypes.DEFAULT_TYPE)
                                        chat_id=update.effective_chat.id)
         return
 
-    saved_items = user_data.get('saved') or []
-    reg_items = user_data.get('items') or []
-    unique_items = list(reg_items)
-    unique_items.extend(x for x in saved_items if x not in unique_items)
-    listing = [item for item in unique_items if item['uid'] == query.data[query.data.find('_') + 1:]]
+    listing = find_listing(user_data, query.data[query.data.find('_') + 1:])
     if not listing:
         logger.warning('User %s tried to save on object that expired', user.username or user.first_name or user.id)
         await query.answer('\u2757 Not available \u2757\n'
                            'Sorry, this object is no longer accessible.\nTry to use /search again.', show_alert=True)
         await query.message.delete()
         return
-    listing = listing[0]
     conn = psycopg2.connect(database=DB_URL.path[1:],
                             host=DB_URL.hostname,
                             user=DB_URL.username,
@@ -1171,7 +1334,7 @@ def main() -> None:
     Run the bot.
     """
     # Create the Application and pass it your bot token.
-    application = Application.builder().token(BOT_TOKEN).post_init(post_init).build()
+    application = Application.builder().token(BOT_TOKEN).post_init(post_init).post_shutdown(post_shutdown).build()
     filterwarnings(action='ignore', message=r".*CallbackQueryHandler", category=PTBUserWarning)
 
     # Set up top level ConversationHandler (selecting action)
@@ -1239,18 +1402,14 @@ def main() -> None:
     application.add_handler(CommandHandler('unset_tracker', unset))
     application.add_handler(CommandHandler('unset_all', unset_all))
 
-    application.add_handler(CallbackQueryHandler(
-        more_info_button, pattern='^[a-f0-9]{8}-?[a-f0-9]{4}-?[a-f0-9]{4}-?[a-f0-9]{4}-?[a-f0-9]{12}$'))
+    application.add_handler(CallbackQueryHandler(more_info_button, pattern='^' + LISTING_ID_PATTERN + '$'))
     application.add_handler(CallbackQueryHandler(
         unset_tracker, pattern='^tracker_[a-f0-9]{8}-?[a-f0-9]{4}-?[a-f0-9]{4}-?[a-f0-9]{4}-?[a-f0-9]{12}$'))
-    application.add_handler(CallbackQueryHandler(
-        add_to_saved, pattern='^add-item_[a-f0-9]{8}-?[a-f0-9]{4}-?[a-f0-9]{4}-?[a-f0-9]{4}-?[a-f0-9]{12}$'))
-    application.add_handler(CallbackQueryHandler(
-        remove_from_saved, pattern='^rm-item_[a-f0-9]{8}-?[a-f0-9]{4}-?[a-f0-9]{4}-?[a-f0-9]{4}-?[a-f0-9]{12}$'))
-    application.add_handler(CallbackQueryHandler(
-        remove_from_saved, pattern='^keep-rm-item_[a-f0-9]{8}-?[a-f0-9]{4}-?[a-f0-9]{4}-?[a-f0-9]{4}-?[a-f0-9]{12}$'))
-    application.add_handler(CallbackQueryHandler(
-        more_info_button, pattern='^keep-item_[a-f0-9]{8}-?[a-f0-9]{4}-?[a-f0-9]{4}-?[a-f0-9]{4}-?[a-f0-9]{12}$'))
+    application.add_handler(CallbackQueryHandler(add_to_saved, pattern='^add-item_' + LISTING_ID_PATTERN + '$'))
+    application.add_handler(CallbackQueryHandler(remove_from_saved, pattern='^rm-item_' + LISTING_ID_PATTERN + '$'))
+    application.add_handler(CallbackQueryHandler(remove_from_saved,
+                                                 pattern='^keep-rm-item_' + LISTING_ID_PATTERN + '$'))
+    application.add_handler(CallbackQueryHandler(more_info_button, pattern='^keep-item_' + LISTING_ID_PATTERN + '$'))
 
     application.add_handler(MessageHandler(~filters.COMMAND, uncaught_message))
     # Run the bot until the user presses Ctrl-C
@@ -162,7 +162,7 @@ async def query_search(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
                                                                                               user_data['location']),
                                        chat_id=chat_id)
     print('-------------', user_data)
-    prum, items = list_announcements(**user_data, starting_ind=starting_ind)
+    prum, items = await list_announcements(**user_data, starting_ind=starting_ind)
     if not items:
         await context.bot.send_message(text='Sorry, no items were found with these filters', chat_id=chat_id)
         return ConversationHandler.END
@@ -221,7 +221,7 @@ async def more_info_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         return
 
     # print(9999999999999999999999999, query.data, type(query.data))
-    listing = listing_info(user_data['items'][int(query.data)]['link'])
+    listing = await listing_info(user_data['items'][int(query.data)]['link'])
     maps_url = 'https://www.google.com/maps/place/' + listing['location'][-1].replace(' ', '+')
     logger.info('Listing url: {}'.format(listing['link']))
     # logger.info('Listing title: {}', listing['title'][0])
@@ -265,7 +265,7 @@ async def collect_data(context: ContextTypes.DEFAULT_TYPE):
     logger.info('User %s is tracking: %s, %s, %s', user_data['username'] or user_data['first_name'],
                 user_data.get('location'), user_data.get('bid_type'), user_data.get('search_query'))
     utc_time_now = datetime.now(timezone.utc)
-    prum, items = list_announcements(**user_data, max_items=TRACKING_INTERVAL / 60)
+    prum, items = await list_announcements(**user_data, max_items=TRACKING_INTERVAL / 60)
     items = list(filter(lambda x: x['date'] > (utc_time_now - timedelta(seconds=TRACKING_INTERVAL)), items))
     if not items:
         logger.info('No new items found')
@@ -1,18 +1,30 @@
-import locale
+import asyncio
+import contextvars
+import hashlib
+import httpx
 import logging
+import multiprocessing
 import psycopg2
+import psycopg2.extras
 import pytz
 import re
-import requests
+import time
 import translators.server as tss
 import uuid
 
-from bs4 import BeautifulSoup, NavigableString
+from cachetools import TTLCache
+from collections import Counter, deque
+from contextlib import asynccontextmanager, contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from constants import *
 import os
 from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
+from extraction import (compare_extracted, extract_details, extract_details_bs4, extract_rows, extract_rows_bs4,
+                        RowStreamExtractor)
 from logtail import LogtailHandler
+from urllib.parse import urlparse
 
 """
 ca is region code where ca=11 is Pirkanmaa (Tampere region)
@@ -30,7 +42,7 @@ l = 0 ?
 w = 1 ?
 c = 0 ?
 w=111&m=210  - Tampere?
-pe=3 - price max (3 means third option)
+ps=2 - price min, pe=3 - price max (3 means third option, assumed to be an index of PRICE_BUCKETS, not verified)
 What is w??
 """
 
@@ -45,15 +57,283 @@ logger = logging.getLogger(__name__)
 if os.getenv('USER') != 'roman':
     logger.addHandler(handler)
 
+_http_client = None
+_host_limiters = {}
+_parse_pool = None
+_results_cache = TTLCache(maxsize=RESULTS_CACHE_SIZE, ttl=RESULTS_CACHE_TTL)
+_details_cache = TTLCache(maxsize=DETAILS_CACHE_SIZE, ttl=DETAILS_CACHE_TTL)
+_unavailable_cache = TTLCache(maxsize=DETAILS_CACHE_SIZE, ttl=UNAVAILABLE_CACHE_TTL)
+_in_flight = {}
+_flights = {}  # key of singleflight -> Flight of the shared call
+metrics = Counter()
+ROW_TAG_RE = re.compile(rb'<a\s[^>]*item_row_flex[^>]*>')
+HREF_RE = re.compile(rb'href="([^"]*)"')
+LISTING_ID_RE = re.compile(r'_(\d+)\.htm')
+WORD_RE = re.compile(r'\w+')
+FINNISH_FOLD = str.maketrans('äöå', 'aoa')
+INTERACTIVE, BACKGROUND = 0, 1  # priority classes of the requests to tori.fi
+PRIORITY_NAMES = ('interactive', 'background')
+request_priority = contextvars.ContextVar('request_priority', default=INTERACTIVE)
+current_flight = contextvars.ContextVar('current_flight', default=None)
 
-def generate_unique_job_name(jobs):
+
+def get_http_client():
+    """
+    Returns shared http client. It keeps connections to tori.fi alive between requests, so it is created lazily
+    inside of the running event loop and reused by every handler and tracker
+    """
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+                                keepalive_expiry=KEEPALIVE_EXPIRY),
+            timeout=httpx.Timeout(REQUEST_TIMEOUT, connect=REQUEST_CONNECT_TIMEOUT),
+            follow_redirects=True)
+    return _http_client
+
+
+class PageUnavailableError(Exception):
+    """
+    Results page could not be downloaded, so the listings after the ones yielded so far are unknown
+    """
+
+
+async def close_http_client():
+    """
+    Closes shared http client and all of its pooled connections
+    """
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+
+class PriorityLimiter:
+    """
+    Limits the number of simultaneous requests with two priority classes. Waiting interactive requests always start
+    before the waiting background ones, and background requests never hold more than background_limit slots, so a user
+    request does not wait for the tracker polls that are already running.
+    Priority of the request is taken from the shared request (Flight) it belongs to or from request_priority of the
+    calling task
+    """
+
+    def __init__(self, limit, background_limit):
+        self.limit = limit
+        self.background_limit = background_limit
+        self.active = [0, 0]
+        self.waiters = (deque(), deque())
+
+    def _can_start(self, priority):
+        return sum(self.active) < self.limit and (priority == INTERACTIVE or self.active[BACKGROUND] <
+                                                  self.background_limit)
+
+    async def acquire(self, priority, flight=None):
+        """
+        :param flight: Flight of the request, it can move the waiting request to the interactive queue
+        :return: priority the slot is held with, it is passed to release
+        """
+        name = PRIORITY_NAMES[priority]
+        metrics[name + '_requests'] += 1
+        if self._can_start(priority) and not any(self.waiters[:priority + 1]):
+            self.active[priority] += 1
+            return priority
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters[priority].append(waiter)
+        if flight is not None:
+            flight.waiting = (self, waiter)
+        started = time.monotonic()
+        try:
+            return await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release(waiter.result())  # the slot was handed over already
+            else:
+                for waiters in self.waiters:
+                    if waiter in waiters:
+                        waiters.remove(waiter)
+            raise
+        finally:
+            metrics[name + '_wait_seconds'] += time.monotonic() - started
+            if flight is not None:
+                flight.waiting = None
+
+    def release(self, priority):
+        self.active[priority] -= 1
+        self._wake()
+
+    def promote(self, waiter):
+        """
+        Moves the waiting background request to the end of the interactive queue
+        """
+        if waiter not in self.waiters[BACKGROUND]:
+            return
+        self.waiters[BACKGROUND].remove(waiter)
+        self.waiters[INTERACTIVE].append(waiter)
+        metrics['promoted_requests'] += 1
+        self._wake()
+
+    def _wake(self):
+        for priority in (INTERACTIVE, BACKGROUND):
+            waiters = self.waiters[priority]
+            while waiters and self._can_start(priority):
+                waiter = waiters.popleft()
+                # the waiter of the cancelled task is done before the task removes it from the queue
+                if not waiter.done():
+                    waiter.set_result(priority)
+                    self.active[priority] += 1
+
+    @asynccontextmanager
+    async def slot(self):
+        flight = current_flight.get()
+        priority = await self.acquire(flight.priority if flight is not None else request_priority.get(), flight)
+        try:
+            yield
+        finally:
+            self.release(priority)
+
+
+class Flight:
+    """
+    Request shared by singleflight. It starts with the priority of the caller that has started it and is raised to
+    interactive when an interactive caller joins it
+    """
+    __slots__ = ('priority', 'waiting')
+
+    def __init__(self, priority):
+        self.priority = priority
+        self.waiting = None  # (limiter, waiter) while the request waits for a slot
+
+    def promote(self):
+        self.priority = INTERACTIVE
+        if self.waiting is not None:
+            limiter, waiter = self.waiting
+            limiter.promote(waiter)
+
+
+def host_limiter(url):
+    host = urlparse(url).hostname
+    if host not in _host_limiters:
+        _host_limiters[host] = PriorityLimiter(MAX_CONNECTIONS_PER_HOST, MAX_BACKGROUND_CONNECTIONS_PER_HOST)
+    return _host_limiters[host]
+
+
+@contextmanager
+def background_requests():
+    """
+    Requests sent inside of the block and by the tasks created in it yield to the user requests
+    """
+    token = request_priority.set(BACKGROUND)
+    try:
+        yield
+    finally:
+        request_priority.reset(token)
+
+
+def check_status(response):
+    """
+    Raises httpx.HTTPStatusError unless the status is 2xx or 304 Not Modified, so error pages are never parsed or
+    cached as empty pages
+    """
+    if not response.is_success and response.status_code != 304:
+        raise httpx.HTTPStatusError('Unexpected status {} of {}'.format(response.status_code, response.url),
+                                    request=response.request, response=response)
+
+
+async def fetch_response(url, headers=None):
+    """
+    Sends the request without blocking the event loop. Number of simultaneous connections to one host is limited
+    :param url: str
+    :param headers: additional request headers
+    :return: httpx.Response or None if request has failed or the response is not successful
+    """
+    try:
+        async with host_limiter(url).slot():
+            r = await get_http_client().get(url, headers=headers)
+        check_status(r)
+        return r
+    except httpx.HTTPError as e:
+        logger.warning('Request to {} has failed: {}'.format(url, repr(e)))
+        return None
+
+
+async def fetch(url):
+    """
+    Downloads the page
+    :param url: str
+    :return: bytes or None if request has failed
+    """
+    r = await fetch_response(url)
+    return r.content if r is not None else None
+
+
+async def singleflight(key, coroutine_function, *args):
+    """
+    Runs coroutine_function(*args) once for all of the concurrent callers with the same key, they share its result.
+    Cancelled caller does not cancel the shared call. Interactive caller raises the priority of the shared call
+    """
+    task = _in_flight.get(key)
+    if task is not None:
+        metrics['singleflight_shared'] += 1
+        flight = _flights.get(key)
+        if flight is not None and request_priority.get() < flight.priority:
+            flight.promote()
+        return await asyncio.shield(task)
+    flight = Flight(request_priority.get())
+    context = contextvars.copy_context()
+    context.run(current_flight.set, flight)
+    task = context.run(asyncio.ensure_future, coroutine_function(*args))
+    _in_flight[key] = task
+    _flights[key] = flight
+    task.add_done_callback(lambda _: (_in_flight.pop(key, None), _flights.pop(key, None)))
+    return await asyncio.shield(task)
+
+
+def page_fingerprint(content):
+    """
+    Hash of the first FINGERPRINT_ROWS listing links of the results page. Found with regex, without parsing the page
+    """
+    rows = ROW_TAG_RE.findall(content)[:FINGERPRINT_ROWS]
+    links = [HREF_RE.search(row) for row in rows]
+    return hashlib.sha1(b'\n'.join(link.group(1) for link in links if link)).hexdigest()
+
+
+async def fetch_if_changed(url, fingerprint):
+    """
+    Downloads the results page only if it has changed since the last call with the same fingerprint.
+    Uses ETag/Last-Modified when tori.fi sends them, otherwise compares links of the first listings
+    :param fingerprint: dict with the state of the previous call, updated in place
+    :return: tuple(changed, content)
+    """
+    headers = {}
+    if fingerprint.get('etag'):
+        headers['If-None-Match'] = fingerprint['etag']
+    if fingerprint.get('last_modified'):
+        headers['If-Modified-Since'] = fingerprint['last_modified']
+    r = await fetch_response(url, headers=headers)
+    if r is None:
+        return False, None
+    if r.status_code == 304:
+        metrics['fingerprint_not_modified'] += 1
+        return False, None
+    digest = page_fingerprint(r.content)
+    fingerprint['etag'] = r.headers.get('ETag')
+    fingerprint['last_modified'] = r.headers.get('Last-Modified')
+    if digest == fingerprint.get('digest'):
+        metrics['fingerprint_unchanged'] += 1
+        return False, None
+    fingerprint['digest'] = digest
+    metrics['fingerprint_changed'] += 1
+    return True, r.content
+
+
+def generate_unique_job_name(names, prefix=''):
     """
     Generates unique job name
+    :param names: names in use, set or dict
     """
-    job_name = str(uuid.uuid4())
-    current_jobs = [job.name for job in jobs]
-    while job_name in current_jobs:
-        job_name = str(uuid.uuid4())
+    job_name = prefix + str(uuid.uuid4())
+    while job_name in names:
+        job_name = prefix + str(uuid.uuid4())
     return job_name
 
 
@@ -77,154 +357,733 @@ def params_beautifier(params):
     return nice_str.strip()
 
 
-def string_cleaner(string):
-    return re.sub(r'\s\s+', ' ', string.replace('\n', ' ')).strip()
+def price_filter(goods, min_price=None, max_price=None):
+    return [x for x in goods if (min_price is None or x['price'] > min_price) and
+            (max_price is None or x['price'] < max_price)]
+
+
+def location_hierarchy(options):
+    """
+    Builds the hierarchy of the locations from their tori.fi codes: the location with w= only is the whole country,
+    the one with ca= only is a region, the one with ca= and m= is a city of the region with the same ca=
+    :param options: dict of the location names and their codes, like LOCATION_OPTIONS
+    :return: dict of the location names and the names of their parents, None for the whole country
+    """
+    codes = {name: dict(part.split('=') for part in code.split('&')) for name, code in options.items()}
+    country = next(name for name, code in codes.items() if 'ca' not in code)
+    regions = {code['ca']: name for name, code in codes.items() if 'ca' in code and 'm' not in code}
+    return {name: None if name == country else regions[code['ca']] if 'm' in code else country
+            for name, code in codes.items()}
+
 
+LOCATION_PARENTS = location_hierarchy(LOCATION_OPTIONS)
 
 
-def string_retriever(tag):
+def normalize_locations(locations):
     """
-    Retrieves only strings from the tag. Does not go deeper than base level
-    :param tag:
-    :return: list[str]
+    Reduces the selected locations to the minimal set that covers them: the locations inside of the other selected
+    locations are dropped, e.g. ['Tampere', 'Pirkanmaa', 'Helsinki'] becomes ['Helsinki', 'Pirkanmaa']
+    :return: sorted list[str]
     """
-    return [string_cleaner(str(el.string)) for el in tag.contents if isinstance(el, NavigableString)
-            and not el.string.startswith('<') and string_cleaner(el.string)]
+    selected = set(locations) or set(ANY_SETTINGS[LOCATION])
 
+    def covered(name):
+        parent = LOCATION_PARENTS[name]
+        return parent is not None and (parent in selected or covered(parent))
+    return sorted(name for name in selected if not covered(name))
 
-def price_filter(goods, min_price=None, max_price=None):
-    return [x for x in goods if (min_price is None or x['price'] > min_price) and
-            (max_price is None or x['price'] < max_price)]
 
+def price_buckets(min_price=None, max_price=None):
+    """
+    Finds the widest tori.fi price options that still contain the whole price range
+    :return: tuple(ps or None, pe or None), None means that the option does not narrow the search
+    """
+    ps = pe = None
+    if min_price is not None and min_price > PRICE_BUCKETS[0]:
+        ps = max(i for i, bound in enumerate(PRICE_BUCKETS) if bound <= min_price)
+    if max_price is not None and max_price <= PRICE_BUCKETS[-1]:
+        pe = min(i for i, bound in enumerate(PRICE_BUCKETS) if bound >= max_price)
+    return ps or None, pe
 
-def list_announcements(locations=ANY_SETTINGS[LOCATION], listing_types=ANY_SETTINGS[TYPE_OF_LISTING], search_term='',
-                       category=ANY_SETTINGS[CATEGORY], url=URL + 'li?', goods=None, max_items=MAX_ITEMS_PER_SEARCH,
-                       min_price=None, max_price=None, starting_ind=0, ignore_logs=False, **kwargs):
-    location_query = '&'.join([LOCATION_OPTIONS[loc] for loc in locations])
-    if not goods:
-        goods = []
-    bid_type_query = '&'.join([BID_TYPES[t] for t in listing_types])
+
+def build_search_url(locations=ANY_SETTINGS[LOCATION], listing_types=ANY_SETTINGS[TYPE_OF_LISTING], search_term='',
+                     category=ANY_SETTINGS[CATEGORY], page_num=1, url=URL + 'li?', min_price=None, max_price=None):
+    """
+    Builds url of the tori.fi results page. Selections are sorted and locations are reduced to the ones that cover
+    the selection, so the same search always gets the same url.
+    Price range is pushed into the query as the price options that contain it, if PRICE_PUSHDOWN is on
+    :return: str
+    """
+    location_query = '&'.join([LOCATION_OPTIONS[loc] for loc in normalize_locations(locations)])
+    bid_type_query = '&'.join([BID_TYPES[t] for t in sorted(set(listing_types))])
     category_query = CATEGORIES[category]
     keyword_query = 'q=' + search_term.replace(' ', '+')
-    page_num = starting_ind // MAX_ITEMS_ON_PAGE + 1
     page_num_query = 'o=' + str(page_num)
-    # if True:
-    #     logger.info('Starting index: {}, page number: {}'.format(starting_ind, page_num))
-    r = requests.get('&'.join([url, location_query, bid_type_query, category_query, keyword_query, page_num_query]))
-    if not starting_ind and not ignore_logs:
-        logger.info('Search url: {}'.format('&'.join([url, location_query, bid_type_query,
-                                                      category_query, keyword_query, page_num_query])))
-    soup = BeautifulSoup(r.content, 'html5lib')
-    locale.setlocale(locale.LC_TIME, 'fi_FI.UTF-8')
-    # a list to store quotes
-    list_of_goods = soup.find('div', class_='list_mode_thumb')
-    if not list_of_goods:
-        return starting_ind, goods
-    list_of_goods = list_of_goods.findAll('a', attrs={'class': 'item_row_flex'})  # Add pages caller
-    if not list_of_goods:
-        return starting_ind, goods
-    list_of_goods = list_of_goods[starting_ind % MAX_ITEMS_ON_PAGE:]
-    if not list_of_goods:
-        return starting_ind, goods
-    for listing in list_of_goods:
-        listing_date_str = string_cleaner(listing.find('div', class_='date_image').text)
-        str_split = listing_date_str.split(' ')
-        if len(str_split) == 2:
-            listing_date_str = listing_date_str.replace(TODAY, datetime.today().strftime('%d %Bta'))\
-                .replace(YESTERDAY, (datetime.today() - timedelta(days=1)).strftime('%d %Bta'))
+    price_queries = []
+    if PRICE_PUSHDOWN:
+        ps, pe = price_buckets(min_price, max_price)
+        price_queries = ['{}={}'.format(name, i) for name, i in (('ps', ps), ('pe', pe)) if i is not None]
+    return '&'.join([url, location_query, bid_type_query, category_query, keyword_query, *price_queries,
+                     page_num_query])
+
+
+class SearchSpec:
+    """
+    Immutable search parameters in the canonical form: locations are reduced to their covering set and selections are
+    sorted, so the same search always gets an equal spec. Url of the results pages and the key are computed once.
+    The key does not change between restarts, so it can be stored
+    """
+    __slots__ = ('locations', 'listing_types', 'search_term', 'category', 'min_price', 'max_price', 'base_url', 'url',
+                 'key', '_page_url_prefix')
+    FIELDS = ('locations', 'listing_types', 'search_term', 'category', 'min_price', 'max_price', 'base_url')
+
+    def __init__(self, locations=ANY_SETTINGS[LOCATION], listing_types=ANY_SETTINGS[TYPE_OF_LISTING], search_term='',
+                 category=ANY_SETTINGS[CATEGORY], min_price=None, max_price=None, base_url=URL + 'li?'):
+        init = super().__setattr__
+        init('locations', tuple(normalize_locations(locations)))
+        init('listing_types', tuple(sorted(set(listing_types))))
+        init('search_term', search_term or '')
+        init('category', category)
+        init('min_price', min_price)
+        init('max_price', max_price)
+        init('base_url', base_url)
+        init('url', build_search_url(self.locations, self.listing_types, self.search_term, category, 1, base_url,
+                                     min_price, max_price))
+        init('_page_url_prefix', self.url[:self.url.rindex('o=')])
+        init('key', hashlib.sha1(repr(self._values()).encode()).hexdigest())
+
+    @classmethod
+    def from_params(cls, locations=ANY_SETTINGS[LOCATION], listing_types=ANY_SETTINGS[TYPE_OF_LISTING], search_term='',
+                    category=ANY_SETTINGS[CATEGORY], min_price=None, max_price=None, url=URL + 'li?', **kwargs):
+        """
+        Creates the spec from the search features of the user, the keys that are not search parameters are ignored
+        """
+        return cls(locations, listing_types, search_term, category, min_price, max_price, url)
+
+    def page_url(self, page_num):
+        return self._page_url_prefix + 'o=' + str(page_num)
+
+    def replace(self, **changes):
+        """
+        :return: SearchSpec with the given parameters changed
+        """
+        return SearchSpec(**{**self.to_dict(), **changes})
+
+    def to_dict(self):
+        """
+        :return: dict of the parameters, it can be stored and passed back to SearchSpec
+        """
+        return {name: list(value) if isinstance(value, tuple) else value
+                for name, value in zip(self.FIELDS, self._values())}
+
+    def _values(self):
+        return tuple(getattr(self, name) for name in self.FIELDS)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('SearchSpec is immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError('SearchSpec is immutable')
+
+    def __eq__(self, other):
+        return isinstance(other, SearchSpec) and self.key == other.key
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __reduce__(self):
+        return SearchSpec, self._values()
+
+    def __repr__(self):
+        return 'SearchSpec({})'.format(', '.join('{}={!r}'.format(name, value)
+                                                 for name, value in zip(self.FIELDS, self._values())))
+
+
+HELSINKI_TZ = pytz.timezone('Europe/Helsinki')
+FIN_MONTHS = {**{abbr: i + 1 for i, abbr in enumerate(FIN_MON_ABBREVS)},
+              **{name: i + 1 for i, name in enumerate(FIN_MON_ABBREVS.values())}}
+DATE_RE = re.compile(r'^(?:(?P<relative>{}|{})|(?P<day>\d{{1,2}}) (?P<month>\w+)) '
+                     r'(?P<hour>\d{{1,2}}):(?P<minute>\d{{2}})$'.format(TODAY, YESTERDAY))
+
+
+def parse_date(listing_date_str, now=None):
+    """
+    Converts tori.fi date string (e.g. 'tänään 12:03', '7 maa 18:45') into utc datetime.
+    Does not depend on the locale, so it is safe to call from any thread
+    :param now: aware datetime of the moment the page was loaded, defaults to current time
+    :return: datetime
+    """
+    match = DATE_RE.match(listing_date_str)
+    if not match or (match['month'] and match['month'] not in FIN_MONTHS):
+        raise ValueError('Unknown date format: {}'.format(listing_date_str))
+    now = (now or datetime.now(timezone.utc)).astimezone(HELSINKI_TZ)
+    if match['relative']:
+        day = now.date() - timedelta(days=1 if match['relative'] == YESTERDAY else 0)
+        year, month, day = day.year, day.month, day.day
+    else:
+        year, month, day = now.year, FIN_MONTHS[match['month']], int(match['day'])
+    listing_date = HELSINKI_TZ.localize(datetime(year, month, day, int(match['hour']), int(match['minute'])))
+    if listing_date > now:
+        listing_date = HELSINKI_TZ.localize(datetime(year - 1, month, day, int(match['hour']), int(match['minute'])))
+    return listing_date.astimezone(pytz.utc)
+
+
+def format_date(date):
+    """
+    Formats datetime as Helsinki time (e.g. '18:45, 07 Mar') without changing the locale
+    """
+    date = date.astimezone(HELSINKI_TZ)
+    return '{:%H:%M, %d} {}'.format(date, EN_MON_ABBREVS[date.month - 1])
+
+
+def parse_price(price):
+    """
+    Converts tori.fi price string (e.g. '1 250 €') into int. Missing price means free item
+    """
+    price = price.replace('–', '').strip()
+    if price:
+        price = price[:price.find('€')].split(' ')
+        return int(''.join([p for p in price if p.isnumeric()]))
+    return 0
+
+
+def listing_id(url):
+    """
+    Compact id of the listing that stays the same every time the listing is scraped.
+    It is the number from tori.fi url (e.g. '.../sohva_112233445.htm?ca=11'), other urls are hashed
+    :return: str
+    """
+    match = LISTING_ID_RE.search(url)
+    if match:
+        return match.group(1)
+    return hashlib.sha1(url.split('?')[0].encode()).hexdigest()[:16]
+
+
+def remember_listings(listings, new_listings):
+    """
+    Adds listings to the store of shown listings keyed by id. Listing that was shown again becomes the most recent one,
+    only MAX_SAVED_LISTINGS most recent listings are kept
+    :param listings: dict or None
+    :param new_listings: list[dict]
+    :return: dict
+    """
+    listings = dict(listings or {})
+    for listing in new_listings:
+        listings.pop(listing['uid'], None)
+        listings[listing['uid']] = listing
+    while len(listings) > MAX_SAVED_LISTINGS:
+        listings.pop(next(iter(listings)))
+    return listings
+
+
+def find_listing(user_data, uid):
+    """
+    Finds listing among the listings shown to the user and the saved ones
+    :return: dict or None
+    """
+    return (user_data.get('items') or {}).get(uid) or (user_data.get('saved') or {}).get(uid)
+
+
+def parse_listing_row(row):
+    """
+    Converts a single extracted row of the results page
+    :param row: dict returned by extraction.extract_rows
+    :return: dict
+    """
+    bid_type_str = BID_TYPES_TRANSLATIONS.get(row['bid_type'], 'Unknown')
+    if bid_type_str == 'Unknown':
+        logger.warning('Unexpected behavior. Could not get a type of {}'.format(row['link']))
+    return {'title': row['title'], 'link': row['link'].replace('\xa0', '+'), 'date': parse_date(row['date']),
+            'price': parse_price(row['price']), 'image': row['image'].replace('\xa0', '+') if row['image'] else None,
+            'uid': listing_id(row['link']), 'bid_type': bid_type_str}
+
+
+def extract(fast_extractor, reference_extractor, content, *args):
+    """
+    Runs the extractor selected by HTML_PARSER. In PARSER_COMPAT_CHECK mode the output of the fast extractor is
+    also checked against the reference html5lib one and all of the differences are logged
+    """
+    if HTML_PARSER != 'lxml':
+        return reference_extractor(content, *args)
+    extracted = fast_extractor(content, *args)
+    if PARSER_COMPAT_CHECK:
+        diffs = compare_extracted(extracted, reference_extractor(content, *args))
+        if diffs:
+            logger.warning('Extractor {} differs from {}:\n{}'.format(fast_extractor.__name__,
+                                                                     reference_extractor.__name__, '\n'.join(diffs)))
+    return extracted
+
+
+def get_parse_pool():
+    """
+    Returns pool of PARSE_WORKERS processes for extracting pages, None if pages are extracted inline.
+    The pool is created from the running bot that already has threads, so the workers are started by a forkserver
+    instead of forking the bot with the locks held by its threads
+    """
+    global _parse_pool
+    if _parse_pool is None and PARSE_WORKERS > 0:
+        _parse_pool = ProcessPoolExecutor(max_workers=PARSE_WORKERS,
+                                          mp_context=multiprocessing.get_context('forkserver'))
+    return _parse_pool
+
+
+def close_parse_pool():
+    global _parse_pool
+    if _parse_pool is not None:
+        _parse_pool.shutdown(wait=False)
+        _parse_pool = None
+
+
+async def extract_off_loop(fast_extractor, reference_extractor, content, *args):
+    """
+    Runs the extractor in the process pool, so the event loop is free while the page is parsed.
+    Only raw bytes go to the worker and only the extracted strings come back.
+    Falls back to extracting inline when the pool is disabled, broken or PARSER_COMPAT_CHECK is on
+    """
+    pool = get_parse_pool()
+    if pool is None or PARSER_COMPAT_CHECK:
+        return extract(fast_extractor, reference_extractor, content, *args)
+    extractor = fast_extractor if HTML_PARSER == 'lxml' else reference_extractor
+    try:
+        return await asyncio.get_running_loop().run_in_executor(pool, extractor, content, *args)
+    except BrokenProcessPool:
+        logger.error('Parse pool is broken, it will be restarted. Extracting the page inline')
+        close_parse_pool()
+        metrics['parse_pool_fallbacks'] += 1
+        return extract(fast_extractor, reference_extractor, content, *args)
+
+
+def parse_listings_page(content, skip=0):
+    """
+    Parses the results page
+    :param content: bytes of the page
+    :param skip: number of rows at the top of the page to skip without parsing
+    :return: list[dict]
+    """
+    return [parse_listing_row(row) for row in extract(extract_rows, extract_rows_bs4, content, skip)]
+
+
+async def parse_listings_page_async(content):
+    """
+    Parses the results page, extraction runs in the parse pool if it is enabled
+    :return: list[dict]
+    """
+    return [parse_listing_row(row) for row in await extract_off_loop(extract_rows, extract_rows_bs4, content)]
+
+
+async def get_listings_page(page_url):
+    """
+    Returns parsed results page. Pages are shared between all of the users for RESULTS_CACHE_TTL seconds
+    :return: list[dict] or None if the page could not be downloaded
+    """
+    products = _results_cache.get(page_url)
+    if products is not None:
+        metrics['results_cache_hits'] += 1
+        return products
+    metrics['results_cache_misses'] += 1
+    return await singleflight(('results', page_url), download_listings_page, page_url)
+
+
+async def download_listings_page(page_url):
+    """
+    Downloads and parses the results page into the results cache
+    :return: list[dict] or None if the page could not be downloaded
+    """
+    content = await fetch(page_url)
+    if content is None:
+        return None
+    products = await parse_listings_page_async(content)
+    _results_cache[page_url] = products
+    return products
+
+
+async def stream_listings_page(page_url, enough):
+    """
+    Downloads and parses the results page incrementally. Rows are parsed as the chunks arrive and the connection is
+    closed as soon as enough rows are collected, the rest of the page is not downloaded.
+    Only the completely read page is stored in the results cache, the partly read one is kept by the cursor of
+    iter_announcements and the whole page is downloaded when more rows are needed
+    :param enough: function that takes list[dict] of the rows parsed so far and returns bool
+    :return: tuple(list[dict] or None if the page could not be downloaded, bool whether reading has stopped early)
+    """
+    metrics['results_cache_misses'] += 1
+    extractor = RowStreamExtractor()
+    products = []
+    try:
+        async with host_limiter(page_url).slot():
+            async with get_http_client().stream('GET', page_url) as r:
+                check_status(r)
+                async for chunk in r.aiter_bytes(STREAM_CHUNK_SIZE):
+                    products.extend(parse_listing_row(row) for row in extractor.feed(chunk))
+                    if products and enough(products):
+                        # counts the connections closed before the end of the page
+                        metrics['stream_early_stops'] += 1
+                        return products, True
+    except httpx.HTTPError as e:
+        logger.warning('Request to {} has failed: {}'.format(page_url, repr(e)))
+        return None, False
+    products.extend(parse_listing_row(row) for row in extractor.close())
+    _results_cache[page_url] = products
+    return products, False
+
+
+async def get_listings_pages(urls):
+    """
+    Gets several results pages concurrently
+    :param urls: list[str]
+    :return: list of parsed pages in the same order as urls
+    """
+    if len(urls) == 1:
+        return [await get_listings_page(urls[0])]
+    return await asyncio.gather(*[get_listings_page(page_url) for page_url in urls])
+
+
+def resume_position(products, last_uid, last_date):
+    """
+    Position on the results page right after the last listing shown to the user.
+    If the listing is no longer on the page, the listings newer than it are skipped
+    :return: int
+    """
+    for i, product in enumerate(products):
+        if product['uid'] == last_uid:
+            return i + 1
+    i = 0
+    while i < len(products) and products[i]['date'] > last_date:
+        i += 1
+    return i
+
+
+async def iter_announcements(spec, starting_ind=0, ignore_logs=False, concurrent_pages=1, stream_items=0,
+                             cursor=None):
+    """
+    Yields matching listings one by one as the result pages are downloaded and parsed.
+    Pages are requested lazily, so the consumer can stop at any point without fetching the rest
+    :param spec: SearchSpec
+    :param concurrent_pages: number of consecutive pages fetched at once. Pages are still parsed in order
+    :param stream_items: if the first page is not cached, it is streamed until this number of matching listings is
+    found. If the consumer asks for more, the whole page is downloaded
+    :param cursor: dict that stores the position of the last yielded listing between the calls. If it belongs to the
+    same search and starting_ind, iteration resumes right after that listing instead of counting the offset, and its
+    page is not downloaded again. The rows of a partly streamed page are served first, the rest of the page is
+    downloaded once they run out
+    :return: async generator of (index of the next unseen listing, listing dict)
+    :raises PageUnavailableError: if a results page could not be downloaded
+    """
+    page_num = starting_ind // MAX_ITEMS_ON_PAGE + 1
+    skip = starting_ind % MAX_ITEMS_ON_PAGE
+    prev_last_link = None
+    seen = set()
+    resumed_rows = None
+    if cursor is not None:
+        if cursor.get('search') == spec.key and cursor.get('index') == starting_ind:
+            page_num, resumed_rows, resumed_partial, skip = cursor['page'], cursor['rows'], cursor['partial'], None
+            stream_items = 0
         else:
-            listing_date_str = listing_date_str.replace(str_split[1], FIN_MON_ABBREVS.get(str_split[1], str_split[1]))
-        tz = pytz.timezone('Europe/Helsinki')
-
-        listing_date = datetime.strptime(listing_date_str, '%d %Bta %H:%M')
-        listing_date = listing_date.replace(year=datetime.today().year)
-        date_aware = tz.normalize(tz.localize(listing_date)).astimezone(pytz.utc)
-        if date_aware > datetime.now(timezone.utc):
-            date_aware = date_aware.replace(year=date_aware.year - 1)
-
-        price = listing.find('p', class_='list_price ineuros').text.strip()
-        if price:
-            price = price[:price.find('€')].split(' ')
-            price = int(''.join([p for p in price if p.isnumeric()]))
+            cursor.clear()
+            cursor.update(search=spec.key, seen=set())
+        seen = cursor['seen']
+    concurrent_pages = max(1, min(int(concurrent_pages), MAX_CONCURRENT_PAGES))
+
+    def matches(product):
+        return product['uid'] not in seen and (spec.min_price is None or product['price'] >= spec.min_price) and \
+            (spec.max_price is None or product['price'] <= spec.max_price)
+
+    while True:
+        page_urls = [spec.page_url(page_num + i) for i in range(concurrent_pages)]
+        if not starting_ind and not ignore_logs:
+            logger.info('Search url: {}'.format(page_urls[0]))
+            ignore_logs = True
+        partial = False
+        if resumed_rows is not None:
+            pages, partial = [resumed_rows], resumed_partial
+            resumed_rows = None
+        elif stream_items and concurrent_pages == 1 and page_urls[0] not in _results_cache and \
+                ('results', page_urls[0]) not in _in_flight:
+            products, partial = await stream_listings_page(
+                page_urls[0], lambda rows: sum(map(matches, rows[skip:])) >= stream_items)
+            pages = [products]
+            stream_items = 0
         else:
-            price = 0
+            pages = await get_listings_pages(page_urls)
+        for page_url, products in zip(page_urls, pages):
+            if products is None:
+                raise PageUnavailableError(page_url)
+            if skip is None:
+                skip = resume_position(products or [], cursor['last_uid'], cursor['last_date'])
+            # tori.fi may serve the last page again for the offsets that are out of range.
+            # Full page without rows after skip is the streamed page that was read to the end, the next page follows.
+            # Partial page is the beginning of the streamed page, the rest of it is downloaded below
+            if not products or (not products[skip:] and len(products) < MAX_ITEMS_ON_PAGE and not partial) or \
+                    products[-1]['link'] == prev_last_link:
+                return
+            if not partial:
+                prev_last_link = products[-1]['link']
+            for product in products[skip:]:
+                starting_ind += 1
+                # listings shift between pages while they are downloaded, the same listing is yielded once
+                matching = matches(product)
+                seen.add(product['uid'])
+                if not matching:
+                    continue
+                if cursor is not None:
+                    cursor.update(index=starting_ind, page=page_num, rows=products, partial=partial,
+                                  last_uid=product['uid'], last_date=product['date'])
+                yield starting_ind, product
+            if partial:
+                # the rest of the streamed page is needed, it is downloaded whole
+                skip = len(products)
+                break
+            skip = 0
+            page_num += 1
+
+
+async def poll_search(fingerprint, spec):
+    """
+    Checks whether the first results page of the tracker has changed since its previous poll.
+    Changed page is parsed into the results cache, so the following list_announcements call does not download it again
+    :param fingerprint: dict that stores the state of the tracker between polls
+    :param spec: SearchSpec
+    :return: bool
+    """
+    changed, content = await fetch_if_changed(spec.url, fingerprint)
+    if changed:
+        _results_cache[spec.url] = await parse_listings_page_async(content)
+    return changed
+
+
+def tracker_group(spec):
+    """
+    Name of the polling group of the tracker. Trackers that differ only in keywords and prices share the group
+    :param spec: SearchSpec of the tracker
+    :return: str
+    """
+    return 'group_' + spec.replace(search_term='', min_price=None, max_price=None).key
+
+
+def new_watermark(since):
+    """
+    Creates the high-water mark of the tracker. Dates on tori.fi have minute resolution, so the listings posted
+    during the minute of since are new as well
+    :param since: aware datetime, listings posted before it are not notified
+    :return: dict
+    """
+    return {'date': since.replace(second=0, microsecond=0), 'ids': []}
 
-        bid_type_str = 'Unknown'
-        children = listing.find('div', class_='cat_geo').findChildren(recursive=False)
-        for child in children:
-            if child.text and child.text.strip() in BID_TYPES_TRANSLATIONS:
-                bid_type_str = BID_TYPES_TRANSLATIONS[child.text.strip()]
+
+async def scan_new_listings(watermark, spec, match=None, ignore_logs=False):
+    """
+    Scans the results pages from the top until the listings older than the high-water mark of the tracker and
+    advances the mark. Listing is returned once: the ones posted during the minute of the mark are checked against the
+    most recently returned ids. The search is scanned without prices, so the trackers that differ only in prices share
+    the pages, prices are filtered locally
+    :param watermark: dict created by new_watermark, it is updated in place
+    :param spec: SearchSpec
+    :param match: function that takes a listing and returns whether it is wanted, applied locally after the scan
+    :return: list[dict] of the new matching listings, newest first
+    :raises PageUnavailableError: if a page could not be downloaded, the mark is left as it was, so the next poll
+    scans the same listings again
+    """
+    new_listings = []
+    announcements = iter_announcements(spec.replace(min_price=None, max_price=None), ignore_logs=ignore_logs)
+    try:
+        async for ind, product in announcements:
+            if product['date'] < watermark['date']:
                 break
-        if bid_type_str == 'Unknown':
-            logger.warning('Unexpected behavior. Could not get a type of {}'.format(listing['href']))
-
-        img = listing.find('img', class_='item_image')
-        product = {'title': listing.find('div', class_='li-title').text, 'link': listing['href'].replace('\xa0', '+'),
-                   'date': date_aware, 'price': price, 'image': img['src'].replace('\xa0', '+') if img else None,
-                   'uid': str(uuid.uuid4()), 'bid_type': bid_type_str}
-        if (min_price is None or price >= min_price) and (max_price is None or price <= max_price):
+            if ind > MAX_WATERMARK_PAGES * MAX_ITEMS_ON_PAGE:
+                # the listings past the limit are skipped, the mark still moves to the newest listing
+                metrics['watermark_scan_limit_hits'] += 1
+                logger.warning('Tracker scan of {} stopped after {} pages, older new listings are not sent'.format(
+                    spec, MAX_WATERMARK_PAGES))
+                break
+            if product['uid'] not in watermark['ids']:
+                new_listings.append(product)
+    finally:
+        await announcements.aclose()
+    if new_listings:
+        watermark['date'] = max(watermark['date'], *(product['date'] for product in new_listings))
+        watermark['ids'] = ([product['uid'] for product in new_listings] + watermark['ids'])[:WATERMARK_IDS]
+    return [product for product in new_listings if (spec.min_price is None or product['price'] >= spec.min_price) and
+            (spec.max_price is None or product['price'] <= spec.max_price) and (match is None or match(product))]
+
+
+def fold_finnish(text):
+    """
+    Folds the text for comparison: case and the Finnish letters, 'Pöytä' becomes 'poyta'
+    """
+    return text.casefold().translate(FINNISH_FOLD)
+
+
+def compile_keywords(terms):
+    """
+    Matcher of many search terms against the titles at once. Every word of the term has to be the beginning of some
+    word of the title, so inflected forms match as well ('sohva' matches 'Sohvan'). All of the term words are kept in
+    one set, a word of the title is looked up there by its prefixes of the lengths that occur among the term words
+    :param terms: iterable of str
+    :return: function that takes a title and returns set of the matching terms
+    """
+    term_words = {term: set(WORD_RE.findall(fold_finnish(term))) for term in terms}
+    words = set().union(*term_words.values())
+    lengths = sorted({len(word) for word in words})
+    matched = {}
+
+    def match(title):
+        if title not in matched:
+            found = set()
+            for token in WORD_RE.findall(fold_finnish(title)):
+                found.update(token[:n] for n in lengths if n <= len(token) and token[:n] in words)
+            matched[title] = {term for term, term_word_set in term_words.items() if term_word_set <= found}
+        return matched[title]
+    return match
+
+
+def listing_rate(products):
+    """
+    Estimates how many listings the search gets during TRACKING_INTERVAL from the dates of its first results page
+    :param products: list[dict] of the first page
+    :return: float
+    """
+    if not products:
+        return 0.
+    span = max((products[0]['date'] - products[-1]['date']).total_seconds(), 60.)
+    return len(products) * TRACKING_INTERVAL / span
+
+
+def poll_interval(rate):
+    """
+    Poll interval of the search, so every poll finds about POLL_TARGET_LISTINGS new listings
+    :param rate: estimated listings of the search per TRACKING_INTERVAL or None if unknown
+    :return: seconds between MIN_TRACKING_INTERVAL and MAX_TRACKING_INTERVAL
+    """
+    if rate is None:
+        return TRACKING_INTERVAL
+    if rate <= 0:
+        return MAX_TRACKING_INTERVAL
+    return min(max(POLL_TARGET_LISTINGS * TRACKING_INTERVAL / rate, MIN_TRACKING_INTERVAL), MAX_TRACKING_INTERVAL)
+
+
+async def search_rate(spec):
+    """
+    Listing rate of the search, see listing_rate. The first page is taken from the results cache when it is there
+    :param spec: SearchSpec
+    :return: float or None if the first page could not be downloaded
+    """
+    products = await get_listings_page(spec.url)
+    return listing_rate(products) if products is not None else None
+
+
+def prefer_broad_fetch(rate, searches):
+    """
+    Chooses how the trackers with the same location, type and category but different keywords are polled: one search
+    without keywords matched against the titles locally or one search per keyword. The broad search wins when
+    scanning its new listings takes fewer pages than there are keyword searches
+    :param rate: estimated listings of the search without keywords per TRACKING_INTERVAL or None if unknown
+    :param searches: number of the distinct keyword searches
+    :return: bool
+    """
+    if not BROAD_FETCH or rate is None:
+        return False
+    pages = max(1, -(-int(rate) // MAX_ITEMS_ON_PAGE))
+    return pages <= MAX_WATERMARK_PAGES and pages < searches
+
+
+async def list_announcements(spec=None, goods=None, max_items=MAX_ITEMS_PER_SEARCH, starting_ind=0, ignore_logs=False,
+                             prefetch=True, stream=False, cursor=None, **kwargs):
+    """
+    Collects up to max_items matching listings starting from starting_ind
+    :param spec: SearchSpec, if it is not given, it is created from the search features passed as kwargs
+    :param prefetch: fetch all of the pages that max_items spans concurrently instead of one after another
+    :param stream: stop reading the first page once max_items are found on it
+    :param cursor: dict with the position of the previous call, see iter_announcements
+    :return: tuple(index of the next unseen listing, list[dict])
+    """
+    if not goods:
+        goods = []
+    finished_on = starting_ind
+    concurrent_pages = 1
+    if prefetch:
+        concurrent_pages = (starting_ind % MAX_ITEMS_ON_PAGE + int(max_items) - 1) // MAX_ITEMS_ON_PAGE + 1
+    announcements = iter_announcements(spec or SearchSpec.from_params(**kwargs), starting_ind=starting_ind,
+                                       ignore_logs=ignore_logs, concurrent_pages=concurrent_pages,
+                                       stream_items=int(max_items) if stream else 0, cursor=cursor)
+    try:
+        async for finished_on, product in announcements:
             goods.append(product)
-        starting_ind += 1
-        if len(goods) >= max_items:
-            return starting_ind, goods
-    return list_announcements(locations=locations, listing_types=listing_types, search_term=search_term,
-                              category=category, url=url, ignore_logs=True, starting_ind=starting_ind,
-                              goods=goods, max_items=max_items, min_price=min_price, max_price=max_price, **kwargs)
-
-
-def listing_info(url):
-    r = requests.get(url)
-    soup = BeautifulSoup(r.content, 'html5lib')
-    locale.setlocale(locale.LC_TIME, 'fi_FI.UTF-8')
-    listing = soup.find('div', class_='content')
-    if not listing:
+            if len(goods) >= max_items:
+                break
+    except PageUnavailableError:
+        pass  # the listings found before the failed page are shown
+    finally:
+        await announcements.aclose()
+    return finished_on, goods
+
+
+def parse_listing_info(content, url):
+    """
+    Parses the listing page
+    :return: dict, url if the page could not be parsed or a message if the listing is no longer available
+    """
+    return build_listing_info(extract(extract_details, extract_details_bs4, content), url)
+
+
+async def parse_listing_info_async(content, url):
+    """
+    Parses the listing page, extraction runs in the parse pool if it is enabled
+    """
+    return build_listing_info(await extract_off_loop(extract_details, extract_details_bs4, content), url)
+
+
+def build_listing_info(details, url):
+    """
+    Converts fields extracted from the listing page
+    :param details: dict returned by extraction.extract_details
+    """
+    if details is None:
         return url
-    table_info = listing.find('table', class_='tech_data')
-    if not table_info:
+    if not details:
         return 'Selected listing is no longer available.'
-    listing_date_str = string_cleaner(table_info.find('td', string='Ilmoitus jätetty:').findNext('td').text)
-    str_split = listing_date_str.split(' ')
-    if len(str_split) == 2:
-        listing_date_str = listing_date_str.replace(TODAY, datetime.today().strftime('%d %Bta')) \
-            .replace(YESTERDAY, (datetime.today() - timedelta(days=1)).strftime('%d %Bta'))
-    else:
-        listing_date_str = listing_date_str.replace(str_split[1], FIN_MON_ABBREVS.get(str_split[1], str_split[1]))
-    tz = pytz.timezone('Europe/Helsinki')
-    listing_date = datetime.strptime(listing_date_str, '%d %Bta %H:%M')
-    listing_date = listing_date.replace(year=datetime.today().year)
-    date_aware = tz.normalize(tz.localize(listing_date)).astimezone(pytz.utc)
-    if date_aware > datetime.now(timezone.utc):
-        date_aware = date_aware.replace(year=date_aware.year - 1)
-
-    bid_type_el = table_info.find('td', string='Ilmoitustyyppi:')
-    if bid_type_el:
-        bid_type_str = BID_TYPES_TRANSLATIONS[string_cleaner(bid_type_el.findNext('td').text)]
-    else:
-        bid_type_str = None
+    img = details['image']
+    info = {'title': details['title'], 'date': parse_date(details['date']), 'link': url.replace('\xa0', '+'),
+            'price': parse_price(details['price']), 'location': details['location'],
+            'description': details['description'],
+            'image': img.replace('\xa0', '+') if not img.endswith('.gif') else None,
+            'bid_type': BID_TYPES_TRANSLATIONS[details['bid_type']] if details['bid_type'] else None}
+    return info
 
-    price = listing.find('div', class_='price').span
-    price = price.text.strip() if price.string else price.span.text.strip()
-    price = price.replace('–', '')
-    if price:
-        price = price[:price.find('€')].split(' ')
-        price = int(''.join([p for p in price if p.isnumeric()]))
-    else:
-        price = 0
 
-    seller_info = string_retriever(listing.find('div', id='seller_info').div)
-    descr = '\n'.join(string_retriever(listing.find('div', class_='body')))
-    img = listing.find('img', id='main_image')['src']
+async def listing_info(url):
+    """
+    Returns parsed listing page. Parsed listings and listings that are no longer available are cached by url.
+    Cache lookups and updates happen without awaiting in between, so concurrent handlers see a consistent cache,
+    concurrent requests of the same listing share one download
+    :return: dict, url if the page could not be parsed or a message if the listing is no longer available
+    """
+    info = _details_cache.get(url) or _unavailable_cache.get(url)
+    if info is not None:
+        metrics['details_cache_hits'] += 1
+        return info
+    metrics['details_cache_misses'] += 1
+    return await singleflight(('details', url), download_listing_info, url)
 
-    info = {'title': string_cleaner(listing.find('div', class_='topic').h1.text), 'date': date_aware,
-            'link': url.replace('\xa0', '+'), 'price': price, 'location': seller_info, 'description': descr,
-            'image': img.replace('\xa0', '+') if not img.endswith('.gif') else None, 'bid_type': bid_type_str}
+
+async def download_listing_info(url):
+    """
+    Downloads and parses the listing page into the details cache
+    :return: see listing_info
+    """
+    content = await fetch(url)
+    if content is None:
+        return url
+    info = await parse_listing_info_async(content, url)
+    if isinstance(info, dict):
+        _details_cache[url] = info
+    elif info != url:
+        _unavailable_cache[url] = info
     return info
 
 
 def beautify_items(items, lang='en'):
     if lang == 'fi':  # TODO: future language settings
         lang = 'en'
-    locale.setlocale(locale.LC_TIME, 'en_US.UTF-8')
     sep = '<brgr>'
     translations = tss.google(('\n' + sep + '\n').join([it['title'] for it in items]),
                               from_language='fi', to_language=lang)
@@ -235,15 +1094,13 @@ def beautify_items(items, lang='en'):
         beautified.append('<b><i>{} (Fin.: {})</i></b>\n<b>Price</b>: {}\n<b>Listing type</b>: {}\n<b>Time added</b>:'
                           ' {}'.format(translations[i].strip(), item['title'], str(item['price']) + '€'
                                        if item['price'] else '-', item['bid_type'],
-                                       item['date'].astimezone(pytz.timezone('Europe/Helsinki')).strftime(
-                                           '%H:%M, %d %b')))
+                                       format_date(item['date'])))
     return beautified
 
 
 def beautify_listing(item, trim=True, lang='en'):
     if lang == 'fi':
         lang = 'en'
-    locale.setlocale(locale.LC_TIME, 'en_US.UTF-8')
     sep = '<brgr>'
     translations = tss.google(('\n' + sep + '\n').join([item['title'], item['description']]),
                               from_language='fi', to_language=lang)
@@ -254,7 +1111,7 @@ def beautify_listing(item, trim=True, lang='en'):
                  '<a href="{}">Original post</a>'.format(
                   translations[0].strip(), item['title'], translations[-1].strip(),
                   str(item['price']) + '€' if item['price'] else '-', '/'.join(item['location']), bid_type_str,
-                  item['date'].astimezone(pytz.timezone('Europe/Helsinki')).strftime('%H:%M, %d %b'), item['link'])
+                  format_date(item['date']), item['link'])
     if trim:
         i = 0.95
         while len(beautified) >= 1024 and i >= 0:
@@ -264,7 +1121,7 @@ def beautify_listing(item, trim=True, lang='en'):
                           translations[0].strip(), item['title'],
                           translations[-1][:int(len(translations[1])*i)].strip() + '...',
                           str(item['price']) + '€' if item['price'] else '-', '/'.join(item['location']), bid_type_str,
-                          item['date'].astimezone(pytz.timezone('Europe/Helsinki')).strftime('%H:%M, %d %b'),
+                          format_date(item['date']),
                           item['link'])
             i -= 0.05
 
@@ -272,13 +1129,33 @@ def beautify_listing(item, trim=True, lang='en'):
 
 
 def parse_psql_listings(data):
-    listings = []
+    listings = {}
     for listing in data:
-        listings.append({'title': listing[1], 'link': listing[0], 'date': listing[4], 'price': listing[2],
-                         'image': listing[3], 'bid_type': listing[5], 'uid': listing[6]})
+        listings[listing[6]] = {'title': listing[1], 'link': listing[0], 'date': listing[4], 'price': listing[2],
+                                'image': listing[3], 'bid_type': listing[5], 'uid': listing[6]}
     return listings
 
 
+def get_metrics():
+    """
+    Returns counters of the caches with their hit rates and the request queues of both priority classes
+    """
+    result = dict(metrics)
+    for cache_name in ('results_cache', 'details_cache'):
+        lookups = metrics[cache_name + '_hits'] + metrics[cache_name + '_misses']
+        result[cache_name + '_hit_rate'] = metrics[cache_name + '_hits'] / lookups if lookups else 0.
+    polls = metrics['fingerprint_changed'] + metrics['fingerprint_unchanged'] + metrics['fingerprint_not_modified']
+    result['tracker_poll_skip_ratio'] = 1 - metrics['fingerprint_changed'] / polls if polls else 0.
+    result['results_cache_size'] = len(_results_cache)
+    result['details_cache_size'] = len(_details_cache) + len(_unavailable_cache)
+    result['in_flight_requests'] = len(_in_flight)
+    for priority, name in enumerate(PRIORITY_NAMES):
+        result[name + '_queue_depth'] = sum(len(limiter.waiters[priority]) for limiter in _host_limiters.values())
+        requests = metrics[name + '_requests']
+        result[name + '_wait_avg'] = metrics[name + '_wait_seconds'] / requests if requests else 0.
+    return result
+
+
 def get_saved_from_db(user_id, saved_listings):
     """
     Retrieve Saved listings from db
@@ -299,3 +1176,76 @@ def get_saved_from_db(user_id, saved_listings):
         conn.close()
         result = parse_psql_listings(data)
     return result
+
+
+def _db_connection():
+    return psycopg2.connect(database=DB_URL.path[1:],
+                            host=DB_URL.hostname,
+                            user=DB_URL.username,
+                            password=DB_URL.password,
+                            port=DB_URL.port)
+
+
+def _dump_watermark(watermark):
+    return psycopg2.extras.Json({'date': watermark['date'].isoformat(), 'ids': watermark['ids']})
+
+
+def save_tracker(tracker):
+    """
+    Stores the tracker, so it survives restarts of the bot
+    """
+    conn = _db_connection()
+    cur = conn.cursor()
+    cur.execute(INSERT_TRACKER_SQL, (tracker.name, str(tracker.user_id), tracker.chat_id, str(tracker.user),
+                                     psycopg2.extras.Json(tracker.spec.to_dict()), tracker.beautiful_params,
+                                     _dump_watermark(tracker.watermark), tracker.created_at,
+                                     tracker.expires_at))
+    conn.commit()
+    cur.close()
+    conn.close()
+
+
+def save_watermarks(trackers):
+    """
+    Stores the advanced high-water marks of the trackers in one statement, so the restored trackers do not notify the
+    same listings
+    :param trackers: list[Tracker]
+    """
+    conn = _db_connection()
+    cur = conn.cursor()
+    psycopg2.extras.execute_values(cur, UPDATE_TRACKER_WATERMARKS_SQL,
+                                   [(tracker.name, _dump_watermark(tracker.watermark)) for tracker in trackers])
+    conn.commit()
+    cur.close()
+    conn.close()
+
+
+def delete_trackers(names):
+    """
+    Removes the stopped trackers from db
+    :param names: list[str]
+    """
+    conn = _db_connection()
+    cur = conn.cursor()
+    cur.execute(DELETE_TRACKERS_SQL, (list(names),))
+    conn.commit()
+    cur.close()
+    conn.close()
+
+
+def load_trackers():
+    """
+    Loads the trackers that have not expired yet, the expired ones are removed
+    :return: list[dict] of the arguments of Tracker, without the bot state (original_data)
+    """
+    conn = _db_connection()
+    cur = conn.cursor()
+    cur.execute(LIST_TRACKERS_SQL)
+    data = cur.fetchall()
+    conn.commit()
+    cur.close()
+    conn.close()
+    return [{'name': name, 'spec': SearchSpec(**spec), 'chat_id': chat_id, 'user': username, 'user_id': int(user_id),
+             'beautiful_params': beautiful_params, 'created_at': created_at, 'expires_at': expires_at,
+             'watermark': {'date': datetime.fromisoformat(watermark['date']), 'ids': watermark['ids']}}
+            for name, user_id, chat_id, username, spec, beautiful_params, watermark, created_at, expires_at in data]
@@ -1,7 +1,7 @@
 CREATE TABLE favourites (
-  id VARCHAR(50) NOT NULL UNIQUE,
+  id VARCHAR(50) NOT NULL,
   user_id VARCHAR(50) REFERENCES users (id),
-  url VARCHAR(300) UNIQUE,
+  url VARCHAR(300),
   title VARCHAR(150),
   price INT,
   image_url VARCHAR(300),
@@ -9,5 +9,5 @@ CREATE TABLE favourites (
   listing_type VARCHAR(50),
   is_deleted BOOLEAN DEFAULT FALSE,
   created_at timestamp default now(),
-  PRIMARY KEY (id)
+  PRIMARY KEY (user_id, id)
 );
@@ -0,0 +1,8 @@
+-- Listing ids are taken from tori.fi urls instead of random uuids, one saved record per user and listing
+ALTER TABLE favourites DROP CONSTRAINT favourites_pkey;
+ALTER TABLE favourites DROP CONSTRAINT favourites_id_key;
+ALTER TABLE favourites DROP CONSTRAINT favourites_url_key;
+UPDATE favourites SET id = substring(url from '_([0-9]+)\.htm') WHERE url ~ '_[0-9]+\.htm';
+DELETE FROM favourites a USING favourites b
+  WHERE a.user_id = b.user_id AND a.id = b.id AND a.created_at < b.created_at;
+ALTER TABLE favourites ADD PRIMARY KEY (user_id, id);
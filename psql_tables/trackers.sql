@@ -0,0 +1,13 @@
+CREATE TABLE trackers (
+  name VARCHAR(50) NOT NULL,
+  user_id VARCHAR(50) NOT NULL,
+  chat_id BIGINT NOT NULL,
+  username VARCHAR(50),
+  spec JSONB NOT NULL,
+  beautiful_params TEXT,
+  watermark JSONB NOT NULL,
+  created_at timestamptz NOT NULL,
+  expires_at timestamptz NOT NULL,
+  PRIMARY KEY (name)
+);
+CREATE INDEX trackers_expires_at_idx ON trackers (expires_at);
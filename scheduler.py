@@ -0,0 +1,184 @@
+import heapq
+import itertools
+import random
+import time
+
+from parsing import new_watermark, tracker_group
+
+"""
+Schedule of the trackers. A single job of the job queue ticks the scheduler, it replaces the polling job of every
+tracker group and the expiry job of every tracker.
+
+Every group has its own poll interval, the busy searches are polled more often than the quiet ones. The intervals are
+jittered, so the groups created or restored at the same time drift apart instead of being polled in bursts.
+
+Polls of the groups and expiries of the trackers are kept in two heaps, so a tick only looks at the entries that are
+due. Removed trackers and groups are not searched for in the heaps, their entries are skipped when they are popped,
+and the heaps are rebuilt once most of the entries are stale.
+"""
+
+
+COMPACT_MIN_ENTRIES = 64  # heaps smaller than this are never rebuilt
+
+
+class Tracker:
+    """
+    Ongoing tracker. The bot keeps every tracker in memory, slots keep the record small.
+    original_data is user_data of the owner, the found items are remembered there
+    """
+    __slots__ = ('name', 'spec', 'group', 'chat_id', 'user', 'user_id', 'beautiful_params', 'created_at', 'expires_at',
+                 'watermark', 'ignore_logs', 'original_data')
+
+    def __init__(self, name, spec, chat_id, user, user_id, beautiful_params, created_at, expires_at, watermark=None,
+                 ignore_logs=False, original_data=None):
+        self.name = name
+        self.spec = spec
+        self.group = tracker_group(spec)
+        self.chat_id = chat_id
+        self.user = user
+        self.user_id = user_id
+        self.beautiful_params = beautiful_params
+        self.created_at = created_at
+        self.expires_at = expires_at
+        self.watermark = watermark or new_watermark(created_at)
+        self.ignore_logs = ignore_logs
+        self.original_data = original_data
+
+    def __repr__(self):
+        return 'Tracker(name={!r}, user={!r}, spec={!r})'.format(self.name, self.user, self.spec)
+
+
+class TrackerScheduler:
+    """
+    Trackers by name, indexed by tracker.chat_id and grouped by tracker.group. Every group is polled once per its
+    interval while it has trackers, the interval is the default one until set_interval is called for the group.
+    Times are unix timestamps, the expiries of the trackers are stored as aware datetimes
+    :param jitter: fraction of the interval every poll is moved by at random, earlier or later
+    """
+
+    def __init__(self, interval, jitter=0.):
+        self.interval = interval
+        self.jitter = jitter
+        self.trackers = {}
+        self.chats = {}  # chat_id -> {name: tracker}
+        self.groups = {}  # group -> {name: tracker}
+        self.group_data = {}  # group -> dict, state kept between the polls of the group
+        self._intervals = {}  # group -> seconds between the polls, when it differs from the default interval
+        self._last_poll = {}  # group -> time of the last poll
+        self._next_poll = {}  # group -> time of the next poll
+        self._polls = []  # heap of (time, seq, group)
+        self._expiries = []  # heap of (time, seq, name)
+        self._seq = itertools.count()
+
+    def __len__(self):
+        return len(self.trackers)
+
+    def __contains__(self, name):
+        return name in self.trackers
+
+    def add(self, tracker, first=None, now=None):
+        """
+        Adds the tracker, the group of the tracker is scheduled if it is new
+        :param first: seconds until the first poll of the new group, jittered interval by default
+        """
+        now = time.time() if now is None else now
+        self.trackers[tracker.name] = tracker
+        if tracker.group not in self.groups:
+            self.groups[tracker.group] = {}
+            self.group_data[tracker.group] = {'fingerprints': {}}
+            self._schedule_poll(tracker.group, now + (self._jittered(self.interval) if first is None else first))
+        self.groups[tracker.group][tracker.name] = tracker
+        self.chats.setdefault(tracker.chat_id, {})[tracker.name] = tracker
+        heapq.heappush(self._expiries, (tracker.expires_at.timestamp(), next(self._seq), tracker.name))
+
+    def remove(self, name):
+        """
+        Removes the tracker, its group is unscheduled when it was the last tracker of the group
+        :return: removed tracker or None if there is no such tracker
+        """
+        tracker = self.trackers.pop(name, None)
+        if tracker is None:
+            return None
+        chat = self.chats[tracker.chat_id]
+        del chat[name]
+        if not chat:
+            del self.chats[tracker.chat_id]
+        group = self.groups[tracker.group]
+        del group[name]
+        if not group:
+            del self.groups[tracker.group], self.group_data[tracker.group], self._next_poll[tracker.group]
+            self._intervals.pop(tracker.group, None)
+            self._last_poll.pop(tracker.group, None)
+        self._compact()
+        return tracker
+
+    def chat_trackers(self, chat_id):
+        """
+        :return: list of the trackers of the chat, the oldest first
+        """
+        return list(self.chats.get(chat_id, {}).values())
+
+    def group_trackers(self, group):
+        return list(self.groups.get(group, {}).values())
+
+    def group_interval(self, group):
+        return self._intervals.get(group, self.interval)
+
+    def set_interval(self, group, interval, now=None):
+        """
+        Changes the poll interval of the group, the next poll is moved to the jittered interval after the last one
+        """
+        if group not in self.groups:
+            return
+        now = time.time() if now is None else now
+        self._intervals[group] = interval
+        self._schedule_poll(group, self._last_poll.get(group, now) + self._jittered(interval))
+        self._compact()
+
+    def expired(self, now=None):
+        """
+        Removes the trackers that have expired by now
+        :return: list of the removed trackers, the earliest expiry first
+        """
+        now = time.time() if now is None else now
+        expired = []
+        while self._expiries and self._expiries[0][0] <= now:
+            expires_at, _, name = heapq.heappop(self._expiries)
+            tracker = self.trackers.get(name)
+            if tracker is not None and tracker.expires_at.timestamp() == expires_at:
+                expired.append(self.remove(name))
+        return expired
+
+    def due_groups(self, limit, now=None):
+        """
+        Pops at most limit groups that are due by now and schedules their next polls. The groups left over stay due
+        for the next tick. A group that is late by more than its interval is not polled twice to catch up
+        :return: list of the groups, the most overdue first
+        """
+        now = time.time() if now is None else now
+        due = []
+        while self._polls and self._polls[0][0] <= now and len(due) < limit:
+            poll_time, _, group = heapq.heappop(self._polls)
+            if self._next_poll.get(group) != poll_time:
+                continue
+            due.append(group)
+            self._last_poll[group] = now
+            interval = self._jittered(self.group_interval(group))
+            next_poll = poll_time + interval
+            self._schedule_poll(group, next_poll if next_poll > now else now + interval)
+        return due
+
+    def _jittered(self, interval):
+        return interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def _schedule_poll(self, group, poll_time):
+        self._next_poll[group] = poll_time
+        heapq.heappush(self._polls, (poll_time, next(self._seq), group))
+
+    def _compact(self):
+        if len(self._polls) > COMPACT_MIN_ENTRIES and len(self._polls) > 2 * len(self._next_poll):
+            self._polls = [entry for entry in self._polls if self._next_poll.get(entry[2]) == entry[0]]
+            heapq.heapify(self._polls)
+        if len(self._expiries) > COMPACT_MIN_ENTRIES and len(self._expiries) > 2 * len(self.trackers):
+            self._expiries = [entry for entry in self._expiries if entry[2] in self.trackers]
+            heapq.heapify(self._expiries)
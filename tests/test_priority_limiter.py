@@ -0,0 +1,84 @@
+"""
+Tests of PriorityLimiter: the order the waiting requests start in, promotion of the background requests and the
+requests cancelled while they wait for a slot.
+
+Run from the repository root:
+    python -m unittest discover tests
+"""
+import asyncio
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from parsing import BACKGROUND, INTERACTIVE, PriorityLimiter  # noqa: E402
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+class PriorityLimiterTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_interactive_requests_start_first(self):
+        limiter = PriorityLimiter(1, 1)
+        await limiter.acquire(BACKGROUND)
+        started = []
+
+        async def request(name, priority):
+            started.append((name, await limiter.acquire(priority)))
+
+        tasks = [asyncio.ensure_future(request('background', BACKGROUND)),
+                 asyncio.ensure_future(request('interactive', INTERACTIVE))]
+        await settle()
+        limiter.release(BACKGROUND)
+        await settle()
+        self.assertEqual(started, [('interactive', INTERACTIVE)])
+        limiter.release(INTERACTIVE)
+        await asyncio.gather(*tasks)
+        self.assertEqual(started, [('interactive', INTERACTIVE), ('background', BACKGROUND)])
+
+    async def test_background_limit(self):
+        limiter = PriorityLimiter(2, 1)
+        await limiter.acquire(BACKGROUND)
+        waiting = asyncio.ensure_future(limiter.acquire(BACKGROUND))
+        await settle()
+        self.assertFalse(waiting.done())
+        self.assertEqual(await limiter.acquire(INTERACTIVE), INTERACTIVE)
+        self.assertEqual(limiter.active, [1, 1])
+        limiter.release(BACKGROUND)
+        self.assertEqual(await waiting, BACKGROUND)
+
+    async def test_promoted_request_holds_interactive_slot(self):
+        limiter = PriorityLimiter(2, 1)
+        await limiter.acquire(BACKGROUND)
+        waiting = asyncio.ensure_future(limiter.acquire(BACKGROUND))
+        await settle()
+        limiter.promote(limiter.waiters[BACKGROUND][0])
+        self.assertEqual(await waiting, INTERACTIVE)
+        self.assertEqual(limiter.active, [1, 1])
+        limiter.release(INTERACTIVE)
+        limiter.release(BACKGROUND)
+        self.assertEqual(limiter.active, [0, 0])
+
+    async def test_cancelled_waiter_does_not_take_slot(self):
+        limiter = PriorityLimiter(1, 1)
+        await limiter.acquire(INTERACTIVE)
+        cancelled = asyncio.ensure_future(limiter.acquire(INTERACTIVE))
+        waiting = asyncio.ensure_future(limiter.acquire(INTERACTIVE))
+        await settle()
+        cancelled.cancel()
+        limiter.release(INTERACTIVE)  # runs before the cancelled task removes its waiter
+        self.assertEqual(await waiting, INTERACTIVE)
+        with self.assertRaises(asyncio.CancelledError):
+            await cancelled
+        self.assertEqual(limiter.active, [1, 0])
+        limiter.release(INTERACTIVE)
+        self.assertEqual(limiter.active, [0, 0])
+        self.assertFalse(any(limiter.waiters))
+
+
+if __name__ == '__main__':
+    unittest.main()